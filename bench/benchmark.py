@@ -0,0 +1,253 @@
+'''Offline benchmark of the update cycle.
+
+Starts a fake Nitter and a fake Discord webhook endpoint (see fakes.py) in a child process, seeds a
+scratch database on a local Postgres and runs full update cycles (get_updates, which queues the new
+tweets in the outbox, then draining the outbox through batching and delivery) against them, then
+times the hot helpers on their own:
+
+    python bench/benchmark.py --accounts 10 1000 10000
+
+The database named by --database is dropped and created again for every run, the bot's own database
+is never touched. DB_HOST, DB_PORT, DB_USER and DB_PASS are read from the environment (or .env).
+'''
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Twinx update cycle')
+    parser.add_argument('--accounts', type=int, nargs='+', default=[10, 1000, 10000], help='tracked accounts per run')
+    parser.add_argument('--channels', type=int, default=40, help='channels (webhooks) the accounts are spread over')
+    parser.add_argument('--subs', type=int, default=2, help='channels subscribed to each account')
+    parser.add_argument('--entries', type=int, default=20, help='entries in every feed')
+    parser.add_argument('--churn', type=float, default=0.1, help='share of accounts posting between cycles')
+    parser.add_argument('--new', type=int, default=2, help='statuses posted by each churned account')
+    parser.add_argument('--cycles', type=int, default=3, help='measured cycles per run')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake webhook endpoint takes per request')
+    parser.add_argument('--limit-every', type=int, default=20, help='every n-th request to a webhook gets a 429, 0 for never')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='retry_after sent with the 429 responses')
+    parser.add_argument('--port', type=int, default=18080, help='port of the fake servers')
+    parser.add_argument('--database', default='twinx_bench', help='scratch database, dropped and created again')
+    parser.add_argument('--json', help='also write the results to this file')
+    return parser.parse_args()
+
+
+def configure(args):
+    '''Points the bot code at the fake servers and the scratch database, this has to happen before utils is imported'''
+    os.environ['NITTER_INSTANCES'] = f'http://127.0.0.1:{args.port}'
+    os.environ['DISCORD_API_BASE'] = f'http://127.0.0.1:{args.port}/api'
+    os.environ['DB_NAME'] = args.database
+    os.environ.setdefault('DB_HOST', 'localhost')
+    os.environ.setdefault('UPDATE_INTERVAL', '5')
+
+
+async def start_fakes(args, accounts):
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    process = context.Process(target=fakes.run, daemon=True,
+                              args=(args.port, accounts, args.entries, args.latency, args.limit_every, args.retry_after, ready))
+    process.start()
+    if not await asyncio.to_thread(ready.wait, 30):
+        process.terminate()
+        raise RuntimeError('The fake servers did not start')
+    return process
+
+
+async def recreate_database(args):
+    import asyncpg
+    import utils
+
+    conn = await asyncpg.connect(host=utils.DB_HOST, port=utils.DB_PORT, user=utils.DB_USER,
+                                 password=utils.DB_PASS, database='postgres')
+    try:
+        await conn.execute(f'DROP DATABASE IF EXISTS "{args.database}"')
+        await conn.execute(f'CREATE DATABASE "{args.database}"')
+    finally:
+        await conn.close()
+
+
+async def seed(args, accounts):
+    '''Adds one guild, the channels and the accounts, with seen indexes matching the feeds the fake Nitter starts with'''
+    import utils
+    from feedparser import FeedParserDict
+
+    channels = [(1000 + i, 5000 + i, f'token{i}', 1) for i in range(args.channels)]
+    users = []
+    subs = []
+    for i in range(accounts):
+        username = f'user{i}'
+        ids = [utils.entry_id(FeedParserDict(link=f'http://x/{username}/status/{status}#m'))
+               for status in range(args.entries, 0, -1)]
+        users.append((username, None, utils.advance_seen(None, ids)))
+        for j in range(min(args.subs, args.channels)):
+            subs.append((username, channels[(i + j) % args.channels][0]))
+
+    async with utils.pool.acquire() as conn:
+        await conn.execute('INSERT INTO guilds VALUES (1)')
+        await conn.copy_records_to_table('channels', records=channels)
+        await conn.copy_records_to_table('twitterusers', records=users, columns=['username', 'hash', 'seen'])
+        await conn.copy_records_to_table('subs', records=subs)
+    await utils.load_subscriptions()
+
+
+async def fake_call(session, args, method, path):
+    async with session.request(method, f'http://127.0.0.1:{args.port}{path}') as response:
+        return await response.json()
+
+
+async def run_cycle(usernames, worker, session):
+    '''The same steps as check_updates in bot.py plus the outbox worker, timed one by one'''
+    import utils
+
+    start = time.perf_counter()
+    (new_counts, _) = await utils.get_updates(usernames)
+    polled = time.perf_counter()
+    sent = failed = 0
+    while True:
+        (claimed, batch_sent, batch_failed) = await worker.drain(session)
+        if not claimed:
+            break
+        sent += batch_sent
+        failed += batch_failed
+    delivered = time.perf_counter()
+
+    return {
+        'cycle': delivered - start,
+        'poll': polled - start,
+        'deliver': delivered - polled,
+        'new_tweets': sum(new_counts.values()),
+        'messages': sent,
+        'failed': failed,
+    }
+
+
+async def run(args, accounts):
+    import utils
+    import delivery
+
+    process = await start_fakes(args, accounts)
+    try:
+        await recreate_database(args)
+        await utils.init_pool()
+        await seed(args, accounts)
+        utils.feed_cache.clear()
+
+        usernames = [f'user{i}' for i in range(accounts)]
+
+        async def same_webhook(channel_id):
+            return utils.subscription_cache.webhook(channel_id)
+
+        worker = delivery.OutboxWorker(delivery.DeliveryEngine(on_missing=same_webhook))
+        cycles = []
+
+        await utils.init_session()
+        session = utils.http_session
+
+        cold = await run_cycle(usernames, worker, session)          # every feed downloaded, nothing new yet
+
+        for _ in range(args.cycles):
+            await fake_call(session, args, 'POST', f'/_advance?churn={args.churn}&new={args.new}')
+            cycles.append(await run_cycle(usernames, worker, session))
+
+        await fake_call(session, args, 'POST', f'/_advance?churn={args.churn}&new={args.new}')
+        tracemalloc.start()
+        await run_cycle(usernames, worker, session)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = await fake_call(session, args, 'GET', '/_stats')
+    finally:
+        await utils.close_session()
+        await utils.close_pool()
+        process.terminate()
+        process.join()
+
+    totals = {key: sum(c[key] for c in cycles) / len(cycles) for key in cycles[0]}
+    deliveries = sum(c['messages'] for c in cycles)
+    deliver_time = sum(c['deliver'] for c in cycles)
+    return {
+        'accounts': accounts,
+        'cold_cycle': cold['cycle'],
+        'mean': totals,
+        'deliveries_per_second': deliveries / deliver_time if deliver_time else 0.0,
+        'peak_memory_mb': peak / 2 ** 20,
+        'fake_servers': stats,
+    }
+
+
+def micro_benchmarks(args):
+    '''Times the per-entry helpers and the feed parsers on one synthetic feed'''
+    import feedparser
+    import rss
+    import utils
+
+    body = fakes.FakeNitter(1, args.entries).render('http://127.0.0.1', 'user0', args.entries * 2).encode()
+    feed = rss.parse(body)
+    entry = feed.entries[len(feed.entries) // 2]
+    known = utils.load_seen(utils.advance_seen(None, [utils.entry_id(e) for e in feed.entries[2:]]))
+
+    cases = {
+        'feedparser.parse': lambda: feedparser.parse(body),
+        'rss.parse (full)': lambda: rss.parse(body),
+        'rss.parse (2 new)': lambda: rss.parse(body, lambda e: utils.entry_id(e) in known),
+        'generate_message': lambda: utils.generate_message(feed.feed.title, entry),
+        'create_hash': lambda: utils.create_hash(entry),
+        'create_timestamp': lambda: utils.create_timestamp(entry.published),
+        'entry_id': lambda: utils.entry_id(entry),
+    }
+    results = dict()
+    for (name, case) in cases.items():
+        (number, total) = timeit.Timer(case).autorange()
+        results[name] = total / number * 1e6
+    return results
+
+
+def report(runs, micro):
+    print()
+    print(f'{"accounts":>9} {"cold s":>8} {"cycle s":>8} {"poll s":>8} {"deliver s":>10} '
+          f'{"tweets":>7} {"msgs":>6} {"msg/s":>8} {"304s":>6} {"429s":>6} {"peak MB":>8}')
+    for r in runs:
+        m = r['mean']
+        print(f'{r["accounts"]:>9} {r["cold_cycle"]:>8.3f} {m["cycle"]:>8.3f} {m["poll"]:>8.3f} '
+              f'{m["deliver"]:>10.3f} {m["new_tweets"]:>7.0f} {m["messages"]:>6.0f} {r["deliveries_per_second"]:>8.1f} '
+              f'{r["fake_servers"]["not_modified"]:>6} {r["fake_servers"]["rate_limited"]:>6} {r["peak_memory_mb"]:>8.1f}')
+    print()
+    for (name, microseconds) in micro.items():
+        print(f'{name:>20}: {microseconds:10.2f} µs')
+
+
+async def main(args):
+    runs = []
+    for accounts in args.accounts:
+        print(f'Running {accounts} accounts...', flush=True)
+        runs.append(await run(args, accounts))
+    return runs
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    configure(args)
+    random.seed(0)
+
+    runs = asyncio.run(main(args))
+    micro = micro_benchmarks(args)
+    report(runs, micro)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': runs, 'micro': micro}, f, indent=2)
@@ -0,0 +1,128 @@
+'''Local stand-ins for Nitter and the Discord webhook API, used by the benchmark.
+Both run in one aiohttp app inside a child process so they don't share CPU time with the bot code under test'''
+
+import asyncio
+import random
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+
+BASE_TIME = 1700000000
+
+
+class FakeNitter:
+    '''Serves a synthetic with_replies feed for every account. Each account has a head status id,
+    the feed lists the newest `entries` statuses and /_advance posts new statuses on a share of the accounts'''
+
+    def __init__(self, accounts, entries, seed=0):
+        self.entries = entries
+        self.heads = {f'user{i}': entries for i in range(accounts)}
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.not_modified = 0
+
+    def render(self, base, username, head):
+        items = []
+        for status in range(head, max(head - self.entries, 0), -1):
+            kind = status % 10
+            if kind == 0:
+                title = f'RT by @{username}: retweeted status {status}'
+                creator = f'@other{status % 97}'
+            elif kind == 1:
+                title = f'R to @other{status % 89}: reply {status}'
+                creator = f'@{username}'
+            else:
+                title = f'status {status} of {username}'
+                creator = f'@{username}'
+            items.append(f'''<item><title>{escape(title)}</title><dc:creator>{creator}</dc:creator>
+<description><![CDATA[<p>{escape(title)}</p>]]></description>
+<pubDate>{formatdate(BASE_TIME + status * 60, usegmt=True)}</pubDate>
+<guid>{base}/{username}/status/{status}#m</guid><link>{base}/{username}/status/{status}#m</link></item>''')
+
+        return f'''<?xml version="1.0" encoding="UTF-8"?>
+<rss xmlns:atom="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0">
+<channel><atom:link href="{base}/{username}/with_replies/rss" rel="self" type="application/rss+xml"/>
+<title>{username.capitalize()} / @{username}</title><link>{base}/{username}/with_replies</link>
+<description>Twitter feed for: @{username}. Generated by the benchmark</description><language>en-us</language><ttl>40</ttl>
+<image><title>{username.capitalize()} / @{username}</title><link>{base}/{username}/with_replies</link>
+<url>{base}/pic/{username}.jpg</url><width>128</width><height>128</height></image>
+{''.join(items)}
+</channel></rss>'''
+
+    async def feed(self, request):
+        self.requests += 1
+        username = request.match_info['username']
+        if username not in self.heads:
+            return web.Response(status=404)
+        head = self.heads[username]
+        etag = f'"{head}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=self.render(f'{request.scheme}://{request.host}', username, head), content_type='application/rss+xml',
+                            headers={'ETag': etag})
+
+    async def advance(self, request):
+        churn = float(request.query.get('churn', 0.1))
+        new = int(request.query.get('new', 1))
+        posted = [username for username in self.heads if self.random.random() < churn]
+        for username in posted:
+            self.heads[username] += new
+        return web.json_response({'accounts': len(posted), 'statuses': len(posted) * new})
+
+
+class FakeDiscord:
+    '''Accepts webhook executions after a simulated latency, with the rate-limit headers Discord sends.
+    Every `limit_every`-th request to a webhook gets a 429 instead'''
+
+    def __init__(self, latency, limit_every, retry_after):
+        self.latency = latency
+        self.limit_every = limit_every
+        self.retry_after = retry_after
+        self.counts = dict()
+        self.delivered = 0
+        self.rate_limited = 0
+
+    async def execute(self, request):
+        webhook_id = request.match_info['webhook_id']
+        await request.read()
+        await asyncio.sleep(self.latency)
+
+        count = self.counts.get(webhook_id, 0) + 1
+        self.counts[webhook_id] = count
+        if self.limit_every and count % self.limit_every == 0:
+            self.rate_limited += 1
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': self.retry_after, 'global': False},
+                                     status=429, headers={'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': str(self.retry_after)})
+
+        self.delivered += 1
+        return web.Response(status=204, headers={'X-RateLimit-Limit': '5', 'X-RateLimit-Remaining': '4',
+                                                 'X-RateLimit-Reset-After': '0.4'})
+
+
+async def serve(port, accounts, entries, latency, limit_every, retry_after, ready):
+
+    nitter = FakeNitter(accounts, entries)
+    discord = FakeDiscord(latency, limit_every, retry_after)
+
+    async def stats(request):
+        return web.json_response({'feed_requests': nitter.requests, 'not_modified': nitter.not_modified,
+                                  'delivered': discord.delivered, 'rate_limited': discord.rate_limited})
+
+    app = web.Application()
+    app.router.add_get('/{username}/with_replies/rss', nitter.feed)
+    app.router.add_post('/_advance', nitter.advance)
+    app.router.add_get('/_stats', stats)
+    app.router.add_post('/api/webhooks/{webhook_id}/{webhook_token}', discord.execute)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port, backlog=4096).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+
+def run(port, accounts, entries, latency, limit_every, retry_after, ready):
+    asyncio.run(serve(port, accounts, entries, latency, limit_every, retry_after, ready))
@@ -1,19 +1,69 @@
 import discord
 from discord import default_permissions
 from discord.ext import tasks, commands
-import aiohttp
+import asyncio
+import time
 
 import utils
+import changes
+import delivery
+import metrics
+import scheduler
+import sharding
+
+
+class Twinx(discord.Bot):
+    '''Opens the database pool and the shared HTTP session and starts the change listener, which loads the subscription cache,
+    before connecting to Discord, stops the background workers and closes the session and the pool on shutdown'''
+
+    metrics_runner = None
+    listener_task = None
+    outbox_task = None
+    checked = False                 # sanity_check already ran in this process
+
+    async def start(self, *args, **kwargs):
+        await utils.init_pool()
+        await utils.init_session()
+        self.listener_task = asyncio.create_task(change_listener.run())
+        if utils.METRICS_PORT:
+            self.metrics_runner = await metrics.start_server(utils.METRICS_HOST, utils.METRICS_PORT)
+            utils.logger.info(f"Serving metrics on http://{utils.METRICS_HOST}:{utils.METRICS_PORT}/metrics")
+        await super().start(*args, **kwargs)
+
+    async def close(self):
+        await super().close()
+        if self.listener_task:
+            self.listener_task.cancel()
+            self.listener_task = None
+        if self.outbox_task:                    # messages in flight stay in the outbox and are claimed again later
+            self.outbox_task.cancel()
+            self.outbox_task = None
+        if renew_leases.is_running():
+            renew_leases.cancel()
+            try:
+                await lease_manager.release()
+            except Exception as e:
+                utils.logger.error(f"Error releasing poll leases: {e}")
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+        if utils.media_store:
+            utils.media_store.shutdown()
+        await utils.close_session()
+        await utils.close_pool()
 
 
-bot = discord.Bot()
+if utils.DISCORD_SHARD_COUNT:
+    bot = Twinx(shard_id=int(utils.DISCORD_SHARD_ID), shard_count=int(utils.DISCORD_SHARD_COUNT))
+else:
+    bot = Twinx()
 
 
 # Secondary Functions
 
 async def get_subbed_users(ctx: discord.AutocompleteContext):
     '''This function will be used to get subbed user list when using the remove command'''
-    users = await utils.fetch_subbed_users_by_channel(ctx.interaction.channel.id)
+    users = utils.subscription_cache.users(ctx.interaction.channel.id)
     if not users:
         users.append('---No subscriptions---')
         return users
@@ -25,9 +75,16 @@ async def get_subbed_users(ctx: discord.AutocompleteContext):
 
 @bot.event
 async def on_ready():
-    await utils.sanity_check(bot.guilds)
+    if not bot.checked:                         # on_ready fires again after every gateway reconnect
+        await utils.sanity_check(bot.guilds)
+        bot.checked = True
     utils.logger.info(f"{bot.user} is ready and online!")
-    check_updates.start()
+    if not renew_leases.is_running():
+        renew_leases.start()
+    if not bot.outbox_task:
+        bot.outbox_task = bot.loop.create_task(outbox_worker.run())
+    if not check_updates.is_running():
+        check_updates.start()
 
 
 @bot.event
@@ -56,17 +113,16 @@ async def tweet(ctx, username: discord.Option(str, required = True), description
         (message, name, avatar_url, webhook_id, webhook_token) = result
         await ctx.respond(f"Fetching latest tweet from {name}...", delete_after=5)
 
-        async with aiohttp.ClientSession() as session:
-            webhook = discord.Webhook.partial(webhook_id, webhook_token, session = session)
+        webhook = discord.Webhook.partial(webhook_id, webhook_token, session = utils.http_session)
 
-            try:
-                await webhook.send(content = message, username = name, avatar_url = avatar_url)
-            except discord.errors.NotFound as e:
-                (webhook_id, webhook_token) = await utils.update_webhook(ctx.channel)
-                webhook = discord.Webhook.partial(webhook_id, webhook_token, session = session)
-                await webhook.send(content = message, username = name, avatar_url = avatar_url)
-            except Exception as e:
-                utils.logger.error(f"Error sending message through the webhook or creating a new one: {e}")
+        try:
+            await webhook.send(content = message, username = name, avatar_url = avatar_url)
+        except discord.errors.NotFound as e:
+            (webhook_id, webhook_token) = await utils.update_webhook(ctx.channel)
+            webhook = discord.Webhook.partial(webhook_id, webhook_token, session = utils.http_session)
+            await webhook.send(content = message, username = name, avatar_url = avatar_url)
+        except Exception as e:
+            utils.logger.error(f"Error sending message through the webhook or creating a new one: {e}")
 
 
 # Subscription Commands
@@ -106,44 +162,67 @@ async def list(ctx):
 
 
 # Update events
+
+async def replace_webhook(channel_id):
+    channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)      # the channel may sit on another gateway shard
+    return await utils.update_webhook(channel)
+
+delivery_engine = delivery.DeliveryEngine(on_missing=replace_webhook)
+outbox_worker = delivery.OutboxWorker(delivery_engine)
+
 UPDATE_INTERVAL = int(utils.UPDATE_INTERVAL)
-@tasks.loop(minutes=UPDATE_INTERVAL)
-async def check_updates():
+poll_scheduler = scheduler.PollScheduler(UPDATE_INTERVAL * 60)
+lease_manager = sharding.LeaseManager()
 
-    tweets, subscription_webhooks = await utils.get_updates()
-    webhook_updates = []
+def poll_new_account(username):
+    if lease_manager.owns(username):
+        poll_scheduler.add(username)
 
-    for user in tweets.keys():
-        if not tweets[user]:
-            continue
+change_listener = changes.ChangeListener(on_subscribed=poll_new_account, on_removed=poll_scheduler.forget)
 
-        for (msg, name, avatar_url) in tweets[user]:
-            for (webhook_id, webhook_token, channel_id) in subscription_webhooks[user]:
-                webhook_updates.append((webhook_id, webhook_token, msg, name, avatar_url, channel_id))
+@tasks.loop(seconds=max(utils.LEASE_TTL // 3, 1))
+async def renew_leases():
+    try:
+        await lease_manager.renew()
+    except Exception as e:
+        utils.logger.error(f"Error renewing poll leases: {e}")
 
-    async with aiohttp.ClientSession() as session:
-        new_tweets = len(webhook_updates)
-        for (webhook_id, webhook_token, msg, name, avatar_url, channel_id) in webhook_updates:
-                webhook = discord.Webhook.partial(webhook_id, webhook_token, session=session)
-                try:
-                    await webhook.send(content=msg, username=name, avatar_url=avatar_url)
-                except discord.errors.NotFound:
-                    (webhook_id, webhook_token) = await utils.update_webhook(bot.get_channel(channel_id))
-                    webhook = discord.Webhook.partial(webhook_id, webhook_token, session=session)
-                    await webhook.send(content=msg, username=name, avatar_url=avatar_url)
-                except Exception as e:
-                    utils.logger.error(f"Error sending message through the webhook or creating a new one: {e}")
+@tasks.loop(seconds=utils.SCHEDULER_TICK)
+async def check_updates():
 
-    utils.logger.info(f'Successfully Updated: Sent {new_tweets} new tweets')
+    poll_scheduler.refresh(lease_manager.owns)
+    due = poll_scheduler.pop_due()
+    if not due:
+        return
+
+    start = time.perf_counter()
+    new_counts = dict()
+    try:
+        (new_counts, queued) = await utils.get_updates(due, on_commit=outbox_worker.wake)
+    except Exception as e:                      # an escaping error would stop the loop until the next restart
+        utils.logger.error(f"Error in the update cycle: {e!r}")
+        return
+    finally:
+        poll_scheduler.record(due, new_counts)
+
+    duration = time.perf_counter() - start
+    metrics.cycle_seconds.observe(duration)
+    if duration > UPDATE_INTERVAL * 60:
+        metrics.cycle_overruns.inc()
+        utils.logger.warning(f'Update cycle took {duration:.0f}s, longer than the update interval')
+
+    utils.logger.info(f'Successfully Updated: Queued {queued} new tweets for delivery')
 
 @check_updates.before_loop
 async def before_check_updates():
     await bot.wait_until_ready()
+    await lease_manager.renew()
 
 
 # Bot initialization
 
 bot.add_application_command(subscription)
 
-bot.run(utils.BOT_TOKEN)
+if __name__ == '__main__':                      # the media workers import this module again
+    bot.run(utils.BOT_TOKEN)
 
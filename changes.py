@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import asyncpg
+
+import utils
+
+
+CHANNEL = 'twinx_changes'       # see migrations/006_change_notifications.sql
+RECONNECT_DELAY = 5             # seconds before listening again after the connection dropped
+
+
+class ChangeListener:
+    '''Follows the changes every bot process makes to subs, channels and twitterUsers through LISTEN / NOTIFY
+    and applies them to the subscription cache, so subscriptions take effect without reloading the cache.
+    on_subscribed(username) and on_removed(username) let the poller react to followed and dropped accounts'''
+
+    def __init__(self, on_subscribed=None, on_removed=None):
+        self.on_subscribed = on_subscribed
+        self.on_removed = on_removed
+        self.lookups = set()                # webhook lookups in flight, referenced until they are done
+
+
+    async def run(self):
+        '''Listens on a connection of its own (pooled connections drop their listeners when released),
+        reconnecting whenever it is lost or anything fails'''
+
+        while True:
+            try:
+                conn = await asyncpg.connect(host=utils.DB_HOST, port=utils.DB_PORT, user=utils.DB_USER,
+                                             password=utils.DB_PASS, database=utils.DB_NAME)
+            except Exception as e:
+                utils.db_logger.error(f"Error connecting the change listener: {e!r}")
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+
+            try:
+                lost = asyncio.get_running_loop().create_future()
+                conn.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await conn.add_listener(CHANNEL, self.notified)
+                await utils.load_subscriptions()            # the startup load, then a catch-up on what changed while nobody listened
+                await lost
+                utils.db_logger.error("The change listener lost its connection, listening again")
+            except Exception as e:                      # the cache would stop following changes for good
+                utils.db_logger.error(f"Error in the change listener: {e!r}")
+            finally:
+                conn.terminate()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+    def notified(self, connection, pid, channel, payload):
+
+        change = json.loads(payload)
+        (table, op, row) = (change['table'], change['op'], change['row'])
+        cache = utils.subscription_cache
+
+        if table == 'subs':
+            if op == 'INSERT':
+                cache.add(row['username'], row['channelId'])
+                if self.on_subscribed:
+                    self.on_subscribed(row['username'])
+            else:
+                cache.remove(row['username'], row['channelId'])
+
+        elif table == 'channels':
+            if op == 'DELETE':                          # also sent for the channels of a removed guild
+                cache.remove_channel(row['channelId'])
+            else:                                       # the notification only carries the keys
+                lookup = asyncio.ensure_future(self.load_webhook(row['channelId']))
+                self.lookups.add(lookup)
+                lookup.add_done_callback(self.lookups.discard)
+
+        elif table == 'twitterusers' and op == 'DELETE':
+            if self.on_removed:
+                self.on_removed(row['username'])
+
+
+    async def load_webhook(self, channel_id):
+
+        try:
+            webhook = await utils.fetch_webhook_details(utils.pool, channel_id)
+        except Exception as e:
+            utils.db_logger.error(f"Error loading the webhook of channel {channel_id}: {e!r}")
+            return
+        if webhook:                                     # gone again when nothing is found, its DELETE follows
+            utils.subscription_cache.set_webhook(channel_id, *webhook[0])
@@ -0,0 +1,287 @@
+import asyncio
+import contextlib
+import json
+import os
+import time
+import aiohttp
+
+import metrics
+import utils
+
+
+def batch_updates(webhook_updates, mode=utils.BATCH_MODE):
+    '''Packs the pending items of each webhook into as few messages as Discord's limits allow.
+    'account' only joins tweets from the same account so the webhook keeps its name and avatar,
+    'channel' joins everything headed to a webhook and posts mixed batches as Twinx.
+    Messages with media attached are always sent on their own'''
+
+    if mode not in ('account', 'channel'):
+        return webhook_updates
+
+    max_items = min(utils.BATCH_MAX_ITEMS, utils.MESSAGE_MAX_EMBEDS)    # every vxtwitter link unfurls into an embed
+    groups = dict()
+    for update in webhook_updates:
+        (webhook_id, _, _, name, avatar_url, _, _, _) = update
+        key = (webhook_id, name, avatar_url) if mode == 'account' else webhook_id
+        groups.setdefault(key, []).append(update)
+
+    batched = []
+    for updates in groups.values():
+        chunk = []
+        length = 0
+        for update in updates:
+            msg = update[2]
+            if update[7]:
+                if chunk:
+                    batched.append(join_updates(chunk))
+                    chunk = []
+                    length = 0
+                batched.append(update)
+                continue
+            if chunk and (len(chunk) >= max_items or length + 1 + len(msg) > utils.MESSAGE_MAX_LENGTH):
+                batched.append(join_updates(chunk))
+                chunk = []
+                length = 0
+            length += len(msg) + (1 if chunk else 0)
+            chunk.append(update)
+        if chunk:
+            batched.append(join_updates(chunk))
+
+    return batched
+
+
+def join_updates(chunk):
+
+    (webhook_id, webhook_token, _, name, avatar_url, channel_id, _, _) = chunk[0]
+    if any((update[3], update[4]) != (name, avatar_url) for update in chunk):
+        (name, avatar_url) = ('Twinx', None)
+    msg = '\n'.join(update[2] for update in chunk)
+    outbox_ids = [outbox_id for update in chunk for outbox_id in update[6]]
+    return (webhook_id, webhook_token, msg, name, avatar_url, channel_id, outbox_ids, [])
+
+
+class WebhookNotFound(Exception):
+    pass
+
+
+class DeliveryError(Exception):
+    pass
+
+
+class RateLimitBucket:
+    '''Follows one Discord rate-limit bucket through the X-RateLimit-* response headers'''
+
+    def __init__(self):
+        self.remaining = 1
+        self.reset_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        delay = self.reset_at - time.monotonic()
+        if self.remaining <= 0 and delay > 0:
+            await asyncio.sleep(delay)
+
+    def update(self, headers):
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset_after = headers.get('X-RateLimit-Reset-After')
+        if remaining is not None:
+            self.remaining = int(remaining)
+        if reset_after is not None:
+            self.reset_at = time.monotonic() + float(reset_after)
+
+    def block(self, retry_after):
+        self.remaining = 0
+        self.reset_at = max(self.reset_at, time.monotonic() + retry_after)
+
+
+class DeliveryEngine:
+    '''Sends webhook messages for many channels in parallel.
+    Messages to the same webhook go out in order, each webhook waits on its own rate-limit bucket,
+    and a global bucket plus DELIVERY_CONCURRENCY cap what is sent to Discord as a whole'''
+
+    def __init__(self, on_missing, concurrency=utils.DELIVERY_CONCURRENCY):
+        self.on_missing = on_missing            # coroutine taking a channel id, returns a new (webhook_id, webhook_token)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.global_bucket = RateLimitBucket()
+        self.buckets = dict()                   # webhook id -> RateLimitBucket
+
+
+    async def deliver(self, session, webhook_updates):
+        '''Takes (webhook_id, webhook_token, msg, name, avatar_url, channel_id, outbox_ids, files) items
+        and returns the lists of (sent, failed) items'''
+
+        queues = dict()
+        for update in webhook_updates:
+            queues.setdefault(update[0], []).append(update)
+
+        results = await asyncio.gather(*(self.deliver_to_webhook(session, updates) for updates in queues.values()))
+        sent = [update for (delivered, _) in results for update in delivered]
+        failed = [update for (_, undelivered) in results for update in undelivered]
+        return (sent, failed)
+
+
+    async def deliver_to_webhook(self, session, updates):
+
+        (webhook_id, webhook_token, _, _, _, channel_id, _, _) = updates[0]
+        bucket = self.buckets.setdefault(webhook_id, RateLimitBucket())
+        sent = []
+        failed = []
+
+        async with bucket.lock:
+            for update in updates:
+                (_, _, msg, name, avatar_url, _, _, files) = update
+                payload = {'content': msg, 'username': name, 'avatar_url': avatar_url}
+                try:
+                    try:
+                        await self.send(session, webhook_id, webhook_token, bucket, payload, files)
+                    except WebhookNotFound:
+                        (webhook_id, webhook_token) = await self.on_missing(channel_id)
+                        bucket = self.buckets.setdefault(webhook_id, RateLimitBucket())
+                        await self.send(session, webhook_id, webhook_token, bucket, payload, files)
+                    sent.append(update)
+                    metrics.deliveries.inc(result='sent')
+                except Exception as e:
+                    failed.append(update)
+                    metrics.deliveries.inc(result='failed')
+                    utils.logger.error(f"Error sending message through the webhook or creating a new one: {e!r}")
+
+        return (sent, failed)
+
+
+    async def send(self, session, webhook_id, webhook_token, bucket, payload, files=()):
+        '''Posts one message, as multipart with the files attached when there are any'''
+
+        url = f'{utils.DISCORD_API_BASE}/webhooks/{webhook_id}/{webhook_token}'
+
+        for attempt in range(utils.DELIVERY_RETRIES):
+            await self.global_bucket.wait()
+            await bucket.wait()
+
+            async with self.semaphore, contextlib.AsyncExitStack() as stack:
+                if files:                       # a form can only be sent once, so it is built again for every attempt
+                    form = aiohttp.FormData()
+                    form.add_field('payload_json', json.dumps(payload), content_type='application/json')
+                    for (i, path) in enumerate(files):
+                        form.add_field(f'files[{i}]', stack.enter_context(open(path, 'rb')), filename=os.path.basename(path))
+                    request = session.post(url, data=form, timeout=aiohttp.ClientTimeout(total=utils.DELIVERY_TIMEOUT * (1 + len(files))))
+                else:
+                    request = session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=utils.DELIVERY_TIMEOUT))
+                async with request as response:
+                    bucket.update(response.headers)
+
+                    if response.status < 300:
+                        return
+                    if response.status == 404:
+                        raise WebhookNotFound(f'Webhook {webhook_id} no longer exists')
+                    if response.status == 429:
+                        try:
+                            data = await response.json(content_type=None) or {}
+                        except ValueError:
+                            data = {}
+                        retry_after = float(data.get('retry_after', response.headers.get('Retry-After', 1)))
+                        if data.get('global') or response.headers.get('X-RateLimit-Global'):
+                            self.global_bucket.block(retry_after)
+                            metrics.rate_limits.inc(scope='global')
+                        else:
+                            bucket.block(retry_after)
+                            metrics.rate_limits.inc(scope='webhook')
+                        utils.logger.warning(f"Rate limited on webhook {webhook_id}, retrying in {retry_after:.2f}s")
+                        continue
+                    if response.status < 500:
+                        raise DeliveryError(f'Webhook {webhook_id} returned status {response.status}: {await response.text()}')
+
+            await asyncio.sleep(min(2 ** attempt, 30))          # 5xx from Discord, back off and try again
+
+        raise DeliveryError(f'Gave up on webhook {webhook_id} after {utils.DELIVERY_RETRIES} attempts')
+
+
+class OutboxWorker:
+    '''Delivers the messages get_updates queues in the outbox table.
+    Rows are claimed with FOR UPDATE SKIP LOCKED, so any number of workers can drain the same outbox,
+    and only deleted once Discord accepted them. Failed messages are retried with backoff'''
+
+    def __init__(self, engine, batch_size=utils.OUTBOX_BATCH, idle_interval=utils.OUTBOX_POLL_INTERVAL):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.wakeup = asyncio.Event()
+
+
+    def wake(self):
+        '''Called once new messages were queued, so they don't wait for the next idle check'''
+        self.wakeup.set()
+
+
+    async def run(self):
+
+        while True:
+            self.wakeup.clear()
+            try:
+                (claimed, _, _) = await self.drain(utils.http_session)
+            except Exception as e:
+                utils.logger.error(f"Error delivering messages from the outbox: {e!r}")
+                claimed = 0
+            if claimed:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.idle_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+    async def files(self, media_urls, session):
+        '''Paths of the message's media in this process's media cache. Media queued by another process
+        or evicted since are processed here first, the ones that can't be are left out (the link stays)'''
+        if not media_urls:
+            return []
+        if not utils.media_store:
+            utils.logger.warning("Sending a message without its media, MEDIA_UPLOADS is off in this process")
+            return []
+
+        paths = []
+        for url in media_urls.split():
+            try:
+                name = await utils.media_store.store(url, session)
+            except Exception as e:
+                utils.logger.warning(f"Error preparing the media {url}: {e!r}")
+                name = None
+            path = utils.media_store.path(name) if name else None
+            if not path:
+                utils.logger.warning(f"Sending a message without its attachment {url}")
+                continue
+            paths.append(path)
+        return paths
+
+
+    async def drain(self, session):
+        '''Claims and delivers one batch of the outbox, returns (claimed rows, sent messages, failed messages)'''
+
+        async with utils.pool.acquire() as conn:
+            rows = await utils.claim_outbox(self.batch_size, conn)
+        if not rows:
+            return (0, 0, 0)
+
+        webhook_updates = []
+        missing = []
+        files = await asyncio.gather(*(self.files(row['media'], session) for row in rows))
+        for (row, row_files) in zip(rows, files):
+            webhook = utils.subscription_cache.webhook(row['channelId'])
+            if not webhook:                     # the cache hasn't caught up with the channel yet, try again later
+                missing.append(row['id'])
+                continue
+            (webhook_id, webhook_token) = webhook
+            webhook_updates.append((webhook_id, webhook_token, row['content'], row['name'], row['avatarUrl'],
+                                    row['channelId'], [row['id']], row_files))
+
+        with metrics.outbox_batch_seconds.time():
+            (sent, failed) = await self.engine.deliver(session, batch_updates(webhook_updates))
+
+        async with utils.pool.acquire() as conn:
+            await utils.complete_outbox([outbox_id for update in sent for outbox_id in update[6]], conn)
+            dropped = await utils.retry_outbox([outbox_id for update in failed for outbox_id in update[6]] + missing, conn)
+        if dropped:
+            metrics.outbox_dropped.inc(dropped)
+            utils.logger.error(f'Dropped {dropped} messages after {utils.OUTBOX_MAX_ATTEMPTS} failed attempts')
+
+        utils.logger.info(f'Delivered {len(sent)} messages from the outbox' + (f' ({len(failed)} messages failed)' if failed else ''))
+        return (len(rows), len(sent), len(failed))
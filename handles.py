@@ -0,0 +1,35 @@
+import random
+import time
+from collections import OrderedDict
+
+
+class HandleBackoff:
+    '''Accounts whose feed is gone (404) or empty, each with an exponentially growing, jittered wait before it is fetched again.
+    Only answers about the account itself end up here, failing instances are the InstancePool's business.
+    An account is forgotten as soon as its feed has entries again'''
+
+    def __init__(self, size=10000, base=300, max_backoff=21600):
+        self.size = size
+        self.base = base                    # seconds after the first failure
+        self.max_backoff = max_backoff
+        self.handles = OrderedDict()        # lowercase username -> (consecutive failures, retry at), least recently failed first
+
+    def failure(self, username):
+        key = username.lower()
+        (failures, _) = self.handles.pop(key, (0, 0.0))
+        failures += 1
+        delay = min(self.base * 2 ** min(failures - 1, 32), self.max_backoff)
+        self.handles[key] = (failures, time.monotonic() + delay * random.uniform(0.5, 1))
+        while len(self.handles) > self.size:
+            self.handles.popitem(last=False)
+
+    def success(self, username):
+        self.handles.pop(username.lower(), None)
+
+    def retry_at(self, username):
+        '''Monotonic time before which the account shouldn't be fetched, 0 when it isn't backing off'''
+        (_, retry_at) = self.handles.get(username.lower(), (0, 0.0))
+        return retry_at
+
+    def blocked(self, username):
+        return self.retry_at(username) > time.monotonic()
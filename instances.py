@@ -0,0 +1,60 @@
+import random
+import time
+
+
+LATENCY_SMOOTHING = 0.3         # how fast the latency / error averages follow new requests
+ERROR_PENALTY = 4               # how much a full error rate multiplies an instance's score
+
+
+class Instance:
+    '''One Nitter mirror with a rolling latency and error score'''
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.latency = None             # seconds, moving average
+        self.error_rate = 0.0           # moving average of failed requests
+        self.failures = 0               # consecutive failures
+        self.cooldown_until = 0.0
+
+    def score(self):
+        '''Lower is healthier'''
+        latency = self.latency if self.latency is not None else 1.0
+        return latency * (1 + ERROR_PENALTY * self.error_rate)
+
+
+class InstancePool:
+    '''Routes feed requests to the healthiest Nitter instances and puts failing ones in cooldown'''
+
+    def __init__(self, base_urls, max_failures=3, cooldown=300):
+        self.instances = [Instance(base_url) for base_url in base_urls]
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+    def ranked(self):
+        '''Returns the instances to try in order. The first one is picked at random weighted by health so
+        the load is spread over the mirrors, the rest follow from healthiest to least healthy'''
+
+        now = time.monotonic()
+        available = sorted((i for i in self.instances if i.cooldown_until <= now), key=Instance.score)
+        if not available:                                   # everything is cooling down, try the one that recovers first
+            return sorted(self.instances, key=lambda i: i.cooldown_until)
+
+        first = random.choices(available, weights=[1 / max(i.score(), 0.001) for i in available])[0]
+        available.remove(first)
+        return [first] + available
+
+    def success(self, instance, latency):
+        if instance.latency is None:
+            instance.latency = latency
+        instance.latency = LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * instance.latency
+        instance.error_rate = (1 - LATENCY_SMOOTHING) * instance.error_rate
+        instance.failures = 0
+
+    def failure(self, instance):
+        instance.error_rate = LATENCY_SMOOTHING + (1 - LATENCY_SMOOTHING) * instance.error_rate
+        instance.failures += 1
+        if instance.failures >= self.max_failures:
+            instance.cooldown_until = time.monotonic() + self.cooldown
+            instance.failures = 0
+            return True
+        return False
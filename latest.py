@@ -0,0 +1,54 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class LatestFeeds:
+    '''The most recently fetched feed of each account, so /tweet and /subscription add don't have to go to Nitter
+    for accounts the poller (or an earlier command) fetched moments ago. Feeds expire after ttl seconds,
+    and concurrent lookups of a feed that isn't cached share one fetch'''
+
+    def __init__(self, size=1000, ttl=120):
+        self.size = size
+        self.ttl = ttl
+        self.feeds = OrderedDict()          # lowercase username -> (expires_at, parsed feed), least recently used first
+        self.inflight = dict()              # lowercase username -> task fetching the feed
+
+    def get(self, username):
+        key = username.lower()
+        cached = self.feeds.get(key)
+        if not cached:
+            return None
+        (expires_at, feed) = cached
+        if expires_at < time.monotonic():
+            del self.feeds[key]
+            return None
+        self.feeds.move_to_end(key)
+        return feed
+
+    def put(self, username, feed):
+        key = username.lower()
+        self.feeds[key] = (time.monotonic() + self.ttl, feed)
+        self.feeds.move_to_end(key)
+        while len(self.feeds) > self.size:
+            self.feeds.popitem(last=False)
+
+    def touch(self, username):
+        '''Keeps a cached feed for another ttl, for when its newest entry is known to still be the newest'''
+        key = username.lower()
+        if key in self.feeds:
+            self.put(key, self.feeds[key][1])
+
+    async def get_or_fetch(self, username, fetch):
+        '''Returns the cached feed, or awaits fetch(username), which is expected to put() what it finds'''
+        feed = self.get(username)
+        if feed is not None:
+            return feed
+
+        key = username.lower()
+        task = self.inflight.get(key)
+        if not task:
+            task = asyncio.ensure_future(fetch(username))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)       # one caller giving up doesn't cancel the fetch for the others
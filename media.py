@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import html
+import mimetypes
+import multiprocessing
+import os
+import re
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import ffmpeg
+import imageio_ffmpeg
+
+
+MEDIA_PATTERN = re.compile(r'<(?:img|source)\b[^>]*?\bsrc="(https?://[^"]+)"', re.IGNORECASE)
+MAX_ATTACHMENTS = 4             # a tweet carries four images or one video at most
+AUDIO_BITRATE = 64000           # bits per second kept for the audio of a shrunk video
+MIN_VIDEO_BITRATE = 100000      # videos that would need less than this to fit are posted as a link only
+CHUNK_SIZE = 1 << 16
+SOURCES_SIZE = 10000            # media urls remembered with their processed file
+
+
+def media_urls(entry):
+    '''Absolute URLs of the images and videos in an entry's description, in order'''
+    urls = (html.unescape(url) for url in MEDIA_PATTERN.findall(entry.get('summary') or ''))
+    return list(dict.fromkeys(urls))[:MAX_ATTACHMENTS]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare(source, kind, max_bytes, max_dimension):
+    '''Runs in the process pool. Shrinks the downloaded file until it fits in max_bytes and
+    returns (path, sha256 of its content), or None when it can't be made to fit'''
+
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    result = source
+
+    if os.path.getsize(source) > max_bytes:
+        if kind == 'image':
+            result = source + '.jpg'
+            (ffmpeg.input(source)
+                   .filter('scale', f'min(iw,{max_dimension})', f'min(ih,{max_dimension})', force_original_aspect_ratio='decrease')
+                   .output(result, **{'q:v': 4})
+                   .overwrite_output()
+                   .run(cmd=ffmpeg_exe, quiet=True))
+        else:
+            seconds = float(ffmpeg.probe(source)['format'].get('duration', 0))     # read from the header, nothing is decoded
+            bitrate = int(max_bytes * 8 * 0.9 / max(seconds, 1)) - AUDIO_BITRATE
+            if bitrate < MIN_VIDEO_BITRATE:
+                return None
+            result = source + '.mp4'
+            (ffmpeg.input(source)
+                   .output(result, vcodec='libx264', preset='veryfast', video_bitrate=bitrate, maxrate=bitrate, bufsize=2 * bitrate,
+                           vf=f"scale='min(iw,{max_dimension})':-2", acodec='aac', audio_bitrate=AUDIO_BITRATE, movflags='+faststart')
+                   .overwrite_output()
+                   .run(cmd=ffmpeg_exe, quiet=True))
+        os.remove(source)
+
+    if os.path.getsize(result) > max_bytes:
+        os.remove(result)
+        return None
+    return (result, file_digest(result))
+
+
+class MediaStore:
+    '''Downloads the images and videos of new tweets, shrinks them to Discord's upload limit in a process pool,
+    and keeps the results in a disk cache where every file is named after the sha256 of its content.
+    The cache stays under max_size by dropping the least recently used files. Each media url is processed once,
+    however many channels it is sent to, and only again once its file was evicted'''
+
+    def __init__(self, directory, max_size, max_upload, max_download, max_dimension=2048, workers=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_upload = max_upload
+        self.max_download = max_download
+        self.max_dimension = max_dimension
+        self.workers = workers
+        self.executor = None
+        self.inflight = dict()              # media url -> task processing it
+        self.sources = OrderedDict()        # media url -> cached file name
+
+        os.makedirs(directory, exist_ok=True)
+        self.files = OrderedDict()          # file name -> size, least recently used first
+        names = [name for name in os.listdir(directory) if not name.startswith('.')]
+        for name in sorted(names, key=lambda name: os.path.getmtime(os.path.join(directory, name))):
+            self.files[name] = os.path.getsize(os.path.join(directory, name))
+        self.size = sum(self.files.values())
+
+
+    def path(self, name):
+        '''Path of a cached file, None once it was evicted'''
+        if name not in self.files:
+            return None
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)                  # keeps the LRU order across restarts
+        except FileNotFoundError:           # removed behind the cache's back, processed again when needed
+            self.size -= self.files.pop(name)
+            return None
+        self.files.move_to_end(name)
+        return path
+
+
+    async def store(self, url, session):
+        '''Returns the name of the cached file for the media url, processing it first when needed.
+        Concurrent calls for one url share the work'''
+
+        name = self.sources.get(url)
+        if name in self.files:
+            self.files.move_to_end(name)
+            return name
+
+        task = self.inflight.get(url)
+        if not task:
+            task = asyncio.ensure_future(self.process(url, session))
+            self.inflight[url] = task
+            task.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+
+    async def process(self, url, session):
+
+        (fd, source) = tempfile.mkstemp(dir=self.directory, prefix='.download-')
+        os.close(fd)
+        try:
+            downloaded = await self.download(url, session, source)
+            if not downloaded:
+                return None
+            (kind, extension) = downloaded
+
+            if not self.executor:           # not fork, a forked worker could inherit locks held by the bot's other threads
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('forkserver'))
+            prepared = await asyncio.get_running_loop().run_in_executor(
+                self.executor, prepare, source, kind, self.max_upload, self.max_dimension)
+            if not prepared:
+                return None
+
+            (result, digest) = prepared
+            name = digest + (os.path.splitext(result)[1] if result != source else extension)
+            os.replace(result, os.path.join(self.directory, name))
+            self.add(name)
+            self.sources[url] = name
+            while len(self.sources) > SOURCES_SIZE:
+                self.sources.popitem(last=False)
+            return name
+        finally:
+            for leftover in (source, source + '.jpg', source + '.mp4'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+
+    async def download(self, url, session, path):
+        '''Saves the media at path and returns ('image' or 'video', file extension), or None for anything else or anything too large'''
+
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=120)) as response:
+            if response.status != 200:
+                return None
+            content_type = response.headers.get('Content-Type', '').split(';')[0]
+            kind = content_type.split('/')[0]
+            if kind not in ('image', 'video') or (response.content_length or 0) > self.max_download:
+                return None
+
+            received = 0
+            with open(path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    received += len(chunk)
+                    if received > self.max_download:
+                        return None
+                    f.write(chunk)
+
+        extension = os.path.splitext(url.split('?')[0])[1].lower()
+        if not re.fullmatch(r'\.[a-z0-9]{1,5}', extension):
+            extension = mimetypes.guess_extension(content_type) or '.bin'
+        return (kind, extension)
+
+
+    def add(self, name):
+        size = os.path.getsize(os.path.join(self.directory, name))
+        self.size += size - self.files.pop(name, 0)
+        self.files[name] = size
+        while self.size > self.max_size and len(self.files) > 1:
+            (evicted, evicted_size) = self.files.popitem(last=False)
+            self.size -= evicted_size
+            try:
+                os.remove(os.path.join(self.directory, evicted))
+            except FileNotFoundError:
+                pass
+
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,128 @@
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+registry = []
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = dict()                # label values -> value
+        if not labelnames and self.kind != 'histogram':
+            self.values[()] = 0
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{value}"' for (name, value) in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for (key, value) in self.values.items():
+            lines.append(f'{self.name}{self.format_labels(key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * len(self.buckets), 0, 0.0]     # bucket counts, count, sum
+        (counts, _, _) = state = self.values[key]
+        for (i, bound) in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        state[1] += 1
+        state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for (key, (counts, count, total)) in self.values.items():
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self.format_labels(key, [("le", bound)])} {bucket_count}')
+            lines.append(f'{self.name}_bucket{self.format_labels(key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {count}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {total}')
+        return lines
+
+
+def render():
+    '''Every registered metric in the Prometheus text format'''
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Update cycle metrics
+
+feed_fetch_seconds = Histogram('twinx_feed_fetch_seconds', 'Time to download one feed from a Nitter instance')
+feed_parse_seconds = Histogram('twinx_feed_parse_seconds', 'Time to parse one feed')
+feed_responses = Counter('twinx_feed_responses_total', 'Feed requests by outcome', ('status',))
+cycle_feeds = Histogram('twinx_cycle_feeds', 'Feeds polled per update cycle', buckets=(1, 5, 10, 50, 100, 500, 1000, 5000, 10000))
+cycle_stage_seconds = Histogram('twinx_cycle_stage_seconds', 'Time per update cycle spent fetching and parsing the feeds (wall time) '
+                                'and in database queries (summed), recorded once per cycle', ('stage',))
+cycle_seconds = Histogram('twinx_cycle_seconds', 'Duration of a whole update cycle')
+cycle_overruns = Counter('twinx_cycle_overruns_total', 'Update cycles that ran longer than UPDATE_INTERVAL')
+new_tweets = Counter('twinx_new_tweets_total', 'New tweets found by the update cycle')
+outbox_batch_seconds = Histogram('twinx_outbox_batch_seconds', 'Time to deliver one claimed outbox batch to Discord, recorded once per batch')
+deliveries = Counter('twinx_deliveries_total', 'Webhook messages by outcome', ('result',))
+rate_limits = Counter('twinx_webhook_rate_limits_total', '429 responses from Discord', ('scope',))
+outbox_dropped = Counter('twinx_outbox_dropped_total', 'Messages dropped from the outbox after OUTBOX_MAX_ATTEMPTS failures')
+webhook_recreations = Counter('twinx_webhook_recreations_total', 'Webhooks created again by update_webhook')
+
+
+# HTTP endpoint
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_server(host, port):
+    '''Serves /metrics on host:port and returns the runner to clean up on shutdown'''
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
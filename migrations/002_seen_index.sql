@@ -0,0 +1 @@
+ALTER TABLE twitterUsers ADD COLUMN IF NOT EXISTS "seen" BYTEA DEFAULT NULL;
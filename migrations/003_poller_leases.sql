@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS pollerLeases (
+    "shardId" INT NOT NULL PRIMARY KEY,
+    "owner" TEXT DEFAULT NULL,
+    "expiresAt" TIMESTAMPTZ DEFAULT NULL
+);
+
+CREATE TABLE IF NOT EXISTS pollerWorkers (
+    "workerId" TEXT NOT NULL PRIMARY KEY,
+    "seenAt" TIMESTAMPTZ NOT NULL
+);
@@ -0,0 +1,11 @@
+CREATE TABLE IF NOT EXISTS outbox (
+    "id" BIGSERIAL PRIMARY KEY,
+    "channelId" BIGINT NOT NULL REFERENCES channels ON DELETE CASCADE,
+    "content" TEXT NOT NULL,
+    "name" TEXT NOT NULL,
+    "avatarUrl" TEXT DEFAULT NULL,
+    "attempts" INT NOT NULL DEFAULT 0,
+    "availableAt" TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS outbox_available ON outbox ("availableAt", "id");
@@ -0,0 +1,8 @@
+-- The primary key of subs leads with "username", so lookups and deletes by channel need their own index,
+-- as do the ON DELETE CASCADE lookups from guilds to channels and from channels to the outbox
+
+CREATE INDEX IF NOT EXISTS subs_channel_id ON subs ("channelId");
+
+CREATE INDEX IF NOT EXISTS channels_guild_id ON channels ("guildId");
+
+CREATE INDEX IF NOT EXISTS outbox_channel_id ON outbox ("channelId");
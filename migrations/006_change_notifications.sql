@@ -0,0 +1,37 @@
+-- Publishes every change to the subscription tables on the twinx_changes channel, so running bot processes
+-- can follow them without reloading. Updates of twitterUsers only move the hash and seen index forward and are left out.
+-- Only the keys of a row are sent, any session may LISTEN and the webhook tokens must not travel with them
+
+CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+DECLARE
+    changed RECORD;
+    keys JSON;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'subs' THEN
+        keys := json_build_object('username', changed."username", 'channelId', changed."channelId");
+    ELSIF TG_TABLE_NAME = 'channels' THEN
+        keys := json_build_object('channelId', changed."channelId", 'guildId', changed."guildId");
+    ELSE
+        keys := json_build_object('username', changed."username");
+    END IF;
+    PERFORM pg_notify('twinx_changes', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'row', keys)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS subs_changed ON subs;
+CREATE TRIGGER subs_changed AFTER INSERT OR DELETE ON subs
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
+
+DROP TRIGGER IF EXISTS channels_changed ON channels;
+CREATE TRIGGER channels_changed AFTER INSERT OR UPDATE OR DELETE ON channels
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
+
+DROP TRIGGER IF EXISTS twitterusers_changed ON twitterUsers;
+CREATE TRIGGER twitterusers_changed AFTER INSERT OR DELETE ON twitterUsers
+    FOR EACH ROW EXECUTE FUNCTION notify_change();
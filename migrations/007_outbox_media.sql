@@ -0,0 +1,2 @@
+-- Space separated URLs of the images and videos to upload with the message
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS "media" TEXT DEFAULT NULL;
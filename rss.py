@@ -0,0 +1,63 @@
+import io
+import xml.etree.ElementTree as ET
+from feedparser import FeedParserDict
+
+
+DC_CREATOR = '{http://purl.org/dc/elements/1.1/}creator'
+
+ITEM_FIELDS = {
+    'title': 'title',
+    'link': 'link',
+    'pubDate': 'published',
+    DC_CREATOR: 'author',
+    'description': 'summary',
+}
+
+
+class ParseError(Exception):
+    pass
+
+
+def parse(body, is_known=None):
+    '''Pull parser for the Nitter RSS format. Returns the same shape as feedparser (feed.title, feed.image.href
+    and entries with title, link, published and author), newest entry first. When is_known is given, parsing
+    stops at the first entry it accepts, so only the entries in front of it are built.
+    Raises ParseError for documents that don't look like a Nitter feed, those are left to feedparser'''
+
+    feed = FeedParserDict(feed=FeedParserDict(), entries=[], complete=True)
+    path = []
+    item = None
+
+    try:
+        for (event, element) in ET.iterparse(io.BytesIO(body), events=('start', 'end')):
+            if event == 'start':
+                path.append(element.tag)
+                if element.tag == 'item':
+                    item = FeedParserDict()
+                continue
+
+            path.pop()
+            if item is not None:
+                if element.tag == 'item':
+                    if 'link' not in item or 'published' not in item:
+                        raise ParseError('Feed item without a link or a date')
+                    if is_known and is_known(item):
+                        feed['complete'] = False
+                        break
+                    feed.entries.append(item)
+                    item = None
+                    element.clear()
+                elif element.tag in ITEM_FIELDS and path[-1] == 'item':
+                    item[ITEM_FIELDS[element.tag]] = (element.text or '').strip()
+            elif path[-1:] == ['channel']:
+                if element.tag == 'title':
+                    feed.feed['title'] = (element.text or '').strip()
+                elif element.tag == 'image':
+                    feed.feed['image'] = FeedParserDict(href=(element.findtext('url') or '').strip())
+                element.clear()
+    except ET.ParseError as e:
+        raise ParseError(e)
+
+    if 'title' not in feed.feed or 'image' not in feed.feed:
+        raise ParseError('Feed without a title or an image')
+    return feed
@@ -0,0 +1,107 @@
+import heapq
+import math
+import random
+import time
+
+import utils
+
+
+QUIET_WEIGHT = 0.25             # weight of an account that hasn't posted lately
+RATE_SMOOTHING = 0.3            # how fast the posting rate follows new observations
+
+
+class PollScheduler:
+    '''Gives every tracked account its own next poll time and keeps the accounts in a heap ordered by it.
+    Accounts that post often or feed many channels are polled more often, quiet ones less,
+    and a token bucket keeps the number of polls per minute under POLL_BUDGET'''
+
+    def __init__(self, interval, budget=utils.POLL_BUDGET):
+        self.interval = interval                # seconds, UPDATE_INTERVAL
+        self.budget = budget
+        self.tokens = float(budget)
+        self.refilled_at = time.monotonic()
+
+        self.heap = []                          # (next poll, username)
+        self.next_poll = dict()                 # username -> next poll, None while the poll is running
+        self.last_poll = dict()
+        self.rates = dict()                     # username -> new tweets per interval (moving average)
+        self.subscribers = dict()               # username -> subscribed channel count
+
+
+    def refresh(self, owns=None):
+        '''Picks up the tracked accounts and their subscriber counts from the subscription cache,
+        keeping only the accounts this worker owns. The first polls of accounts picked up here (on startup or
+        with a newly gained lease shard) are spread over the interval, newly followed ones come in through add()'''
+
+        now = time.monotonic()
+        subscriber_counts = utils.subscription_cache.subscriber_counts()
+        if owns:
+            subscriber_counts = {username: count for (username, count) in subscriber_counts.items() if owns(username)}
+
+        for (username, count) in subscriber_counts.items():
+            self.subscribers[username] = count
+            if username not in self.next_poll:
+                self.schedule(username, now + random.uniform(0, self.interval))
+
+        for username in set(self.next_poll) - set(subscriber_counts):
+            self.forget(username)
+
+
+    def add(self, username):
+        '''Polls a newly followed account right away instead of at the next refresh'''
+        if not self.next_poll or username in self.next_poll:        # the first refresh spreads everything out
+            return
+        self.subscribers[username] = len(utils.subscription_cache.channels(username))
+        self.schedule(username, time.monotonic())
+
+
+    def schedule(self, username, at):
+        self.next_poll[username] = at
+        heapq.heappush(self.heap, (at, username))
+
+
+    def forget(self, username):
+        for state in (self.next_poll, self.last_poll, self.rates, self.subscribers):
+            state.pop(username, None)
+
+
+    def pop_due(self):
+        '''Returns the accounts whose poll is due, as far as the poll budget allows'''
+
+        now = time.monotonic()
+        if self.budget:
+            self.tokens = min(self.budget, self.tokens + (now - self.refilled_at) * self.budget / 60)
+        self.refilled_at = now
+
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            if self.budget and self.tokens < 1:
+                break
+            (at, username) = heapq.heappop(self.heap)
+            if self.next_poll.get(username) != at:          # rescheduled or forgotten since it was pushed
+                continue
+            self.next_poll[username] = None
+            self.tokens -= 1
+            due.append(username)
+        return due
+
+
+    def record(self, usernames, new_counts):
+        '''Updates the posting rate of the polled accounts from their number of new tweets and schedules their next poll'''
+
+        now = time.monotonic()
+        for username in usernames:
+            if username not in self.next_poll:
+                continue
+            elapsed = max(now - self.last_poll.get(username, now - self.interval), 1)
+            observed = new_counts.get(username, 0) * self.interval / elapsed
+            self.rates[username] = RATE_SMOOTHING * observed + (1 - RATE_SMOOTHING) * self.rates.get(username, 1.0)
+            self.last_poll[username] = now
+            at = now + self.next_interval(username) * random.uniform(0.9, 1.1)
+            self.schedule(username, max(at, utils.dead_handles.retry_at(username)))     # missing and empty feeds back off
+
+
+    def next_interval(self, username):
+
+        weight = (self.rates.get(username, 1.0) + QUIET_WEIGHT) * (1 + math.log2(max(self.subscribers.get(username, 1), 1)))
+        return min(max(self.interval / weight, self.interval * utils.POLL_MIN_INTERVAL), self.interval * utils.POLL_MAX_INTERVAL)
@@ -0,0 +1,77 @@
+import math
+import time
+import zlib
+
+import utils
+
+
+def shard_of(username, shard_count):
+    '''Stable shard of a username, the same in every process'''
+    return zlib.crc32(username.encode('utf-8')) % shard_count
+
+
+class LeaseManager:
+    '''Splits the tracked accounts between the running bot processes. Usernames hash into POLL_SHARDS shards,
+    every shard has a lease row in Postgres, and each worker holds a fair share of the leases. Leases of a
+    worker that stops renewing them expire after LEASE_TTL seconds and are picked up by the others'''
+
+    def __init__(self, worker_id=utils.WORKER_ID, shard_count=utils.POLL_SHARDS, ttl=utils.LEASE_TTL):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.ttl = ttl
+        self.owned = frozenset()
+        self.workers = 1
+        self.valid_until = 0.0                  # local deadline, so a stalled worker stops polling before its leases lapse
+
+
+    def owns(self, username):
+        if time.monotonic() > self.valid_until:
+            return False
+        return shard_of(username, self.shard_count) in self.owned
+
+
+    async def renew(self):
+        '''Renews our leases, claims free or expired ones up to a fair share and gives back what is above it'''
+
+        started = time.monotonic()
+        async with utils.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('INSERT INTO pollerLeases ("shardId") SELECT generate_series(0, $1 - 1) ON CONFLICT DO NOTHING', self.shard_count)
+                await conn.execute('''INSERT INTO pollerWorkers ("workerId", "seenAt") VALUES ($1, now())
+                                      ON CONFLICT ("workerId") DO UPDATE SET "seenAt" = now()''', self.worker_id)
+                await conn.execute('DELETE FROM pollerWorkers WHERE "seenAt" < now() - make_interval(secs => $1)', self.ttl)
+
+                workers = await conn.fetchval('SELECT count(*) FROM pollerWorkers')
+                fair_share = math.ceil(self.shard_count / max(workers, 1))
+
+                owned = await conn.fetch('''UPDATE pollerLeases SET "expiresAt" = now() + make_interval(secs => $2)
+                                            WHERE "owner" = $1 AND "expiresAt" > now() AND "shardId" < $3
+                                            RETURNING "shardId"''', self.worker_id, self.ttl, self.shard_count)
+                owned = sorted(shard for (shard,) in owned)
+
+                if len(owned) > fair_share:
+                    await conn.execute('UPDATE pollerLeases SET "owner" = NULL, "expiresAt" = NULL WHERE "shardId" = ANY($1::int[])',
+                                       owned[fair_share:])
+                    owned = owned[:fair_share]
+                elif len(owned) < fair_share:
+                    claimed = await conn.fetch('''UPDATE pollerLeases SET "owner" = $1, "expiresAt" = now() + make_interval(secs => $2)
+                                                  WHERE "shardId" IN (SELECT "shardId" FROM pollerLeases
+                                                                      WHERE ("owner" IS NULL OR "expiresAt" <= now()) AND "shardId" < $4
+                                                                      ORDER BY "shardId" LIMIT $3 FOR UPDATE SKIP LOCKED)
+                                                  RETURNING "shardId"''', self.worker_id, self.ttl, fair_share - len(owned), self.shard_count)
+                    owned += [shard for (shard,) in claimed]
+
+        if set(owned) != self.owned:
+            utils.logger.info(f"Worker {self.worker_id} now polls {len(owned)} of {self.shard_count} shards ({workers} workers)")
+        self.owned = frozenset(owned)
+        self.workers = workers
+        self.valid_until = started + self.ttl
+
+
+    async def release(self):
+        '''Hands our leases back on shutdown so the other workers don't have to wait for them to expire'''
+        async with utils.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('UPDATE pollerLeases SET "owner" = NULL, "expiresAt" = NULL WHERE "owner" = $1', self.worker_id)
+                await conn.execute('DELETE FROM pollerWorkers WHERE "workerId" = $1', self.worker_id)
+        self.owned = frozenset()
@@ -0,0 +1,49 @@
+class SubscriptionCache:
+    '''In-memory copy of the subscription graph. It is loaded once from the database, and every
+    function that changes subscriptions or webhooks writes to it right after the database'''
+
+    def __init__(self):
+        self.channel_users = dict()         # channel id -> {username: None}, kept in subscription order
+        self.user_channels = dict()         # username -> set of channel ids
+        self.webhooks = dict()              # channel id -> (webhook_id, webhook_token)
+
+    def load(self, channels, subs):
+        self.channel_users = dict()
+        self.user_channels = dict()
+        self.webhooks = {channel_id: (webhook_id, webhook_token) for (channel_id, webhook_id, webhook_token) in channels}
+        for (username, channel_id) in subs:
+            self.add(username, channel_id)
+
+    def set_webhook(self, channel_id, webhook_id, webhook_token):
+        self.webhooks[channel_id] = (webhook_id, webhook_token)
+
+    def add(self, username, channel_id):
+        self.channel_users.setdefault(channel_id, dict())[username] = None
+        self.user_channels.setdefault(username, set()).add(channel_id)
+
+    def remove(self, username, channel_id):
+        self.channel_users.get(channel_id, dict()).pop(username, None)
+        channels = self.user_channels.get(username, set())
+        channels.discard(channel_id)
+        if not channels:
+            self.user_channels.pop(username, None)
+
+    def remove_all(self, channel_id):
+        for username in list(self.channel_users.pop(channel_id, dict())):
+            self.remove(username, channel_id)
+
+    def remove_channel(self, channel_id):
+        self.remove_all(channel_id)
+        self.webhooks.pop(channel_id, None)
+
+    def users(self, channel_id):
+        return list(self.channel_users.get(channel_id, dict()))
+
+    def webhook(self, channel_id):
+        return self.webhooks.get(channel_id)
+
+    def subscriber_counts(self):
+        return {username: len(channels) for (username, channels) in self.user_channels.items()}
+
+    def channels(self, username):
+        return list(self.user_channels.get(username, ()))
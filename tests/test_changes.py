@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import asyncpg
+import pytest
+
+import changes
+import utils
+from subscriptions import SubscriptionCache
+
+
+class FakeConnection:
+
+    def __init__(self, failure=None):
+        self.failure = failure
+        self.terminated = False
+
+    def add_termination_listener(self, callback):
+        self.on_terminate = callback
+
+    async def add_listener(self, channel, callback):
+        if self.failure:
+            raise self.failure
+
+    def terminate(self):
+        self.terminated = True
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = SubscriptionCache()
+    monkeypatch.setattr(utils, 'subscription_cache', cache)
+    monkeypatch.setattr(changes, 'RECONNECT_DELAY', 0)
+    return cache
+
+
+def test_the_listener_reconnects_after_any_error(cache, monkeypatch):
+    attempts = [OSError('refused'), FakeConnection(asyncpg.InterfaceError('another operation is in progress')),
+                FakeConnection(RuntimeError('unexpected')), FakeConnection()]
+    connections = []
+    loaded = asyncio.Event()
+
+    async def connect(**kwargs):
+        attempt = attempts.pop(0)
+        if isinstance(attempt, Exception):
+            raise attempt
+        connections.append(attempt)
+        return attempt
+
+    async def load_subscriptions():
+        loaded.set()
+
+    monkeypatch.setattr(asyncpg, 'connect', connect)
+    monkeypatch.setattr(utils, 'load_subscriptions', load_subscriptions)
+
+    async def main():
+        task = asyncio.ensure_future(changes.ChangeListener().run())
+        await asyncio.wait_for(loaded.wait(), 5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+
+    assert not attempts
+    assert all(connection.terminated for connection in connections)
+
+
+def test_notifications_update_the_cache(cache, monkeypatch):
+    subscribed = []
+    removed = []
+
+    async def fetch_webhook_details(conn, channel_id):
+        return [(channel_id + 1, 'token')]
+
+    monkeypatch.setattr(utils, 'fetch_webhook_details', fetch_webhook_details)
+    listener = changes.ChangeListener(on_subscribed=subscribed.append, on_removed=removed.append)
+
+    def notify(table, op, **row):
+        listener.notified(None, 0, changes.CHANNEL, json.dumps({'table': table, 'op': op, 'row': row}))
+
+    async def main():
+        notify('channels', 'INSERT', channelId=10, guildId=1)
+        notify('subs', 'INSERT', username='a', channelId=10)
+        notify('subs', 'INSERT', username='b', channelId=10)
+        notify('subs', 'DELETE', username='b', channelId=10)
+        notify('twitterusers', 'DELETE', username='b')
+        await asyncio.gather(*listener.lookups)
+
+    asyncio.run(main())
+
+    assert cache.webhook(10) == (11, 'token')
+    assert cache.users(10) == ['a']
+    assert (subscribed, removed) == (['a', 'b'], ['b'])
@@ -0,0 +1,47 @@
+import delivery
+
+
+def update(outbox_id, msg='https://vxtwitter.com/a/status/1', name='A', webhook_id=1, files=()):
+    return (webhook_id, 'token', msg, name, f'https://pbs.example/{name}.jpg', 10 + webhook_id, [outbox_id], list(files))
+
+
+def test_batching_off_leaves_the_messages_alone():
+    updates = [update(1), update(2)]
+
+    assert delivery.batch_updates(updates, mode='off') is updates
+
+
+def test_account_mode_joins_tweets_of_one_account_per_webhook():
+    updates = [update(1, name='A'), update(2, name='B'), update(3, name='A'), update(4, name='A', webhook_id=2)]
+    batched = delivery.batch_updates(updates, mode='account')
+
+    assert [(webhook_id, name, ids) for (webhook_id, _, _, name, _, _, ids, _) in batched] == [
+        (1, 'A', [1, 3]), (1, 'B', [2]), (2, 'A', [4])]
+    assert batched[0][2] == 'https://vxtwitter.com/a/status/1\nhttps://vxtwitter.com/a/status/1'
+
+
+def test_channel_mode_posts_mixed_batches_as_twinx():
+    batched = delivery.batch_updates([update(1, name='A'), update(2, name='B')], mode='channel')
+
+    assert len(batched) == 1
+    (_, _, _, name, avatar_url, channel_id, ids, files) = batched[0]
+    assert (name, avatar_url, channel_id, ids, files) == ('Twinx', None, 11, [1, 2], [])
+
+
+def test_batches_respect_the_item_and_length_limits(monkeypatch):
+    monkeypatch.setattr(delivery.utils, 'BATCH_MAX_ITEMS', 3)
+    monkeypatch.setattr(delivery.utils, 'MESSAGE_MAX_LENGTH', 25)
+
+    by_items = delivery.batch_updates([update(i, msg='x') for i in range(7)], mode='account')
+    by_length = delivery.batch_updates([update(i, msg='y' * 10) for i in range(3)], mode='account')
+
+    assert [ids for (_, _, _, _, _, _, ids, _) in by_items] == [[0, 1, 2], [3, 4, 5], [6]]
+    assert [ids for (_, _, _, _, _, _, ids, _) in by_length] == [[0, 1], [2]]
+    assert all(len(msg) <= 25 for (_, _, msg, _, _, _, _, _) in by_length)
+
+
+def test_messages_with_media_go_out_alone_and_in_order():
+    updates = [update(1), update(2, files=['a.jpg']), update(3), update(4)]
+    batched = delivery.batch_updates(updates, mode='account')
+
+    assert [(ids, files) for (_, _, _, _, _, _, ids, files) in batched] == [([1], []), ([2], ['a.jpg']), ([3, 4], [])]
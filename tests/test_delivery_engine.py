@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import delivery
+import metrics
+import utils
+
+
+class FakeDiscord:
+    '''Webhook endpoint answering each request with the next scripted (status, json, headers) for its webhook'''
+
+    def __init__(self, scripts):
+        self.scripts = scripts              # webhook id -> list of responses, 204 once they run out
+        self.requests = []                  # (webhook id, content, monotonic time)
+
+    async def execute(self, request):
+        webhook_id = int(request.match_info['webhook_id'])
+        self.requests.append((webhook_id, (await request.json())['content'], time.monotonic()))
+        script = self.scripts.get(webhook_id, [])
+        (status, data, headers) = script.pop(0) if script else (204, None, {})
+        if data is None:
+            return web.Response(status=status, headers=headers)
+        return web.json_response(data, status=status, headers=headers)
+
+
+def update(webhook_id, msg):
+    return (webhook_id, 'token', msg, 'A', None, 100 + webhook_id, [msg], [])
+
+
+def deliver(scripts, updates, on_missing=None):
+    '''Runs the updates through a DeliveryEngine against the fake endpoint, returns ((sent, failed), fake)'''
+    fake = FakeDiscord(scripts)
+
+    async def main():
+        app = web.Application()
+        app.router.add_post('/api/webhooks/{webhook_id}/{token}', fake.execute)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            utils.DISCORD_API_BASE = str(server.make_url('/api'))
+            engine = delivery.DeliveryEngine(on_missing=on_missing)
+            return await engine.deliver(session, updates)
+
+    return (asyncio.run(main()), fake)
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):                       # deliver() points DISCORD_API_BASE at the fake
+    monkeypatch.setattr(utils, 'DISCORD_API_BASE', utils.DISCORD_API_BASE)
+    monkeypatch.setattr(utils, 'DELIVERY_RETRIES', 3)
+
+
+def test_messages_to_one_webhook_keep_their_order():
+    ((sent, failed), fake) = deliver({}, [update(1, 'a'), update(2, 'x'), update(1, 'b'), update(1, 'c')])
+
+    assert len(sent) == 4 and not failed
+    assert [content for (webhook_id, content, _) in fake.requests if webhook_id == 1] == ['a', 'b', 'c']
+
+
+def test_429_waits_retry_after_then_retries():
+    before = metrics.rate_limits.values.get(('webhook',), 0)
+    ((sent, failed), fake) = deliver({1: [(429, {'retry_after': 0.2, 'global': False}, {})]}, [update(1, 'a')])
+
+    assert len(sent) == 1 and not failed
+    ((_, _, first), (_, _, second)) = fake.requests
+    assert second - first >= 0.2
+    assert metrics.rate_limits.values[('webhook',)] == before + 1
+
+
+def test_global_429_holds_every_webhook():
+    ((sent, _), fake) = deliver({1: [(429, {'retry_after': 0.2, 'global': True}, {})]}, [update(1, 'a'), update(2, 'b')])
+
+    assert len(sent) == 2
+    limited_at = fake.requests[0][2]
+    assert all(at - limited_at >= 0.2 for (_, _, at) in fake.requests[2:])
+
+
+def test_exhausted_bucket_waits_for_its_reset():
+    headers = {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.2'}
+    ((sent, _), fake) = deliver({1: [(204, None, headers)]}, [update(1, 'a'), update(1, 'b')])
+
+    assert len(sent) == 2
+    assert fake.requests[1][2] - fake.requests[0][2] >= 0.2
+
+
+def test_missing_webhook_is_replaced_once():
+    replaced = []
+
+    async def on_missing(channel_id):
+        replaced.append(channel_id)
+        return (2, 'new token')
+
+    ((sent, failed), fake) = deliver({1: [(404, {'message': 'Unknown Webhook'}, {})]}, [update(1, 'a')], on_missing)
+
+    assert replaced == [101]
+    assert [webhook_id for (webhook_id, _, _) in fake.requests] == [1, 2]
+    assert len(sent) == 1 and not failed
+
+
+def test_client_errors_fail_without_retrying():
+    ((sent, failed), fake) = deliver({1: [(400, {'message': 'Bad'}, {})]}, [update(1, 'a'), update(1, 'b')])
+
+    assert [msg for (_, _, msg, _, _, _, _, _) in failed] == ['a']
+    assert [msg for (_, _, msg, _, _, _, _, _) in sent] == ['b']
+    assert len(fake.requests) == 2
@@ -0,0 +1,34 @@
+import time
+
+from handles import HandleBackoff
+
+
+def test_backoff_doubles_up_to_the_maximum():
+    handles = HandleBackoff(base=100, max_backoff=300)
+    delays = []
+    for _ in range(4):
+        handles.failure('User')
+        delays.append(handles.retry_at('user') - time.monotonic())
+
+    assert 50 - 1 <= delays[0] <= 100
+    assert 100 - 1 <= delays[1] <= 200
+    assert 150 - 1 <= delays[3] <= 300
+    assert handles.blocked('USER')
+
+
+def test_success_forgets_the_account():
+    handles = HandleBackoff()
+    handles.failure('user')
+    handles.success('User')
+
+    assert handles.retry_at('user') == 0
+    assert not handles.blocked('user')
+
+
+def test_least_recently_failed_accounts_are_dropped():
+    handles = HandleBackoff(size=2)
+    for username in ('a', 'b', 'c'):
+        handles.failure(username)
+
+    assert not handles.blocked('a')
+    assert handles.blocked('b') and handles.blocked('c')
@@ -0,0 +1,49 @@
+import random
+
+from instances import InstancePool
+
+
+def test_ranked_tries_every_instance_healthiest_first_after_a_weighted_pick():
+    pool = InstancePool(['https://a/', 'https://b', 'https://c'])
+    (a, b, c) = pool.instances
+    pool.success(a, 0.1)
+    pool.success(b, 1.0)
+    pool.success(c, 3.0)
+
+    random.seed(1)
+    firsts = [pool.ranked()[0] for _ in range(1000)]
+    ranked = pool.ranked()
+
+    assert a.base_url == 'https://a'
+    assert sorted(ranked, key=lambda i: i.base_url) == [a, b, c]
+    assert ranked[1:] == sorted(ranked[1:], key=lambda i: i.score())
+    assert firsts.count(a) > firsts.count(b) > firsts.count(c) > 0
+
+
+def test_failing_instances_cool_down():
+    pool = InstancePool(['https://a', 'https://b'], max_failures=2, cooldown=300)
+    (a, b) = pool.instances
+
+    assert not pool.failure(a)
+    assert pool.failure(a)                  # the second consecutive failure starts the cooldown
+    assert pool.ranked() == [b]
+    assert a.failures == 0
+
+
+def test_a_success_resets_the_failure_count():
+    pool = InstancePool(['https://a'], max_failures=2)
+    (a,) = pool.instances
+    pool.failure(a)
+    pool.success(a, 0.5)
+
+    assert not pool.failure(a)
+    assert a.error_rate > 0
+
+
+def test_when_everything_cools_down_the_first_to_recover_is_tried_first():
+    pool = InstancePool(['https://a', 'https://b'], max_failures=1, cooldown=300)
+    (a, b) = pool.instances
+    pool.failure(b)
+    pool.failure(a)
+
+    assert pool.ranked() == [b, a]
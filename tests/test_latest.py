@@ -0,0 +1,71 @@
+import asyncio
+
+from latest import LatestFeeds
+
+
+def test_feeds_expire_after_the_ttl():
+    feeds = LatestFeeds(ttl=-1)
+    feeds.put('User', 'feed')
+
+    assert feeds.get('user') is None
+    assert 'user' not in feeds.feeds
+
+
+def test_least_recently_used_feeds_are_dropped():
+    feeds = LatestFeeds(size=2)
+    feeds.put('a', 1)
+    feeds.put('b', 2)
+    feeds.get('a')
+    feeds.put('c', 3)
+
+    assert (feeds.get('a'), feeds.get('b'), feeds.get('c')) == (1, None, 3)
+
+
+def test_touch_only_renews_cached_feeds():
+    feeds = LatestFeeds()
+    feeds.touch('missing')
+    feeds.put('user', 'feed')
+    (expires_at, _) = feeds.feeds['user']
+    feeds.touch('USER')
+
+    assert 'missing' not in feeds.feeds
+    assert feeds.feeds['user'][0] >= expires_at
+
+
+def test_concurrent_lookups_share_one_fetch():
+    feeds = LatestFeeds()
+    fetches = []
+
+    async def fetch(username):
+        fetches.append(username)
+        await asyncio.sleep(0.01)
+        feeds.put(username, f'feed of {username}')
+        return f'feed of {username}'
+
+    async def main():
+        results = await asyncio.gather(*(feeds.get_or_fetch(username, fetch) for username in ('user', 'User', 'USER')))
+        return (results, await feeds.get_or_fetch('user', fetch))
+
+    (results, cached) = asyncio.run(main())
+
+    assert results == ['feed of user'] * 3
+    assert cached == 'feed of user'
+    assert fetches == ['user']
+    assert not feeds.inflight
+
+
+def test_a_cancelled_caller_leaves_the_fetch_running():
+    feeds = LatestFeeds()
+
+    async def fetch(username):
+        await asyncio.sleep(0.02)
+        return 'feed'
+
+    async def main():
+        first = asyncio.ensure_future(feeds.get_or_fetch('user', fetch))
+        second = asyncio.ensure_future(feeds.get_or_fetch('user', fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == 'feed'
@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import delivery
+import media
+import utils
+
+
+class FakeMediaStore:
+    '''Has the media urls of known processed, anything else is processed on demand or fails'''
+
+    def __init__(self, tmp_path, known=(), failing=()):
+        self.tmp_path = tmp_path
+        self.names = {url: self.write(url) for url in known}
+        self.failing = set(failing)
+        self.stored = []
+
+    def write(self, url):
+        name = url.rsplit('/', 1)[-1]
+        (self.tmp_path / name).write_bytes(b'media')
+        return name
+
+    async def store(self, url, session):
+        self.stored.append(url)
+        if url in self.failing:
+            raise OSError('download failed')
+        return self.names.setdefault(url, self.write(url))
+
+    def path(self, name):
+        return str(self.tmp_path / name)
+
+
+def test_media_queued_by_another_process_is_processed_on_claim(tmp_path, monkeypatch):
+    store = FakeMediaStore(tmp_path, known=['https://pbs.example/a.jpg'])
+    monkeypatch.setattr(utils, 'media_store', store)
+    worker = delivery.OutboxWorker(engine=None)
+
+    paths = asyncio.run(worker.files('https://pbs.example/a.jpg https://pbs.example/b.mp4', session=None))
+
+    assert paths == [str(tmp_path / 'a.jpg'), str(tmp_path / 'b.mp4')]
+    assert store.stored == ['https://pbs.example/a.jpg', 'https://pbs.example/b.mp4']
+
+
+def test_missing_attachments_are_logged(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(utils, 'media_store', FakeMediaStore(tmp_path, failing=['https://pbs.example/gone.jpg']))
+    worker = delivery.OutboxWorker(engine=None)
+
+    with caplog.at_level(logging.WARNING, logger='Twinx'):
+        paths = asyncio.run(worker.files('https://pbs.example/gone.jpg https://pbs.example/ok.jpg', session=None))
+
+    assert paths == [str(tmp_path / 'ok.jpg')]
+    assert 'without its attachment https://pbs.example/gone.jpg' in caplog.text
+
+
+@pytest.mark.parametrize('media_urls', [None, ''])
+def test_messages_without_media_have_no_files(media_urls, monkeypatch):
+    monkeypatch.setattr(utils, 'media_store', None)
+
+    assert asyncio.run(delivery.OutboxWorker(engine=None).files(media_urls, session=None)) == []
+
+
+def cache_file(directory, name, size, mtime):
+    path = directory / name
+    path.write_bytes(b'x' * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_the_cache_is_loaded_least_recently_used_first(tmp_path):
+    cache_file(tmp_path, 'new.jpg', 10, 2000)
+    cache_file(tmp_path, 'old.jpg', 20, 1000)
+    cache_file(tmp_path, '.download-x', 99, 3000)             # an interrupted download
+
+    store = media.MediaStore(str(tmp_path), max_size=100, max_upload=10, max_download=10)
+
+    assert list(store.files) == ['old.jpg', 'new.jpg']
+    assert store.size == 30
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    store = media.MediaStore(str(tmp_path), max_size=25, max_upload=10, max_download=10)
+    for name in ('a.jpg', 'b.jpg'):
+        (tmp_path / name).write_bytes(b'x' * 10)
+        store.add(name)
+    store.path('a.jpg')
+    (tmp_path / 'c.jpg').write_bytes(b'x' * 10)
+    store.add('c.jpg')
+
+    assert list(store.files) == ['a.jpg', 'c.jpg']
+    assert store.size == 20
+    assert not (tmp_path / 'b.jpg').exists()
+    assert store.path('b.jpg') is None
+
+
+def test_files_removed_behind_the_cache_count_as_evicted(tmp_path):
+    store = media.MediaStore(str(tmp_path), max_size=100, max_upload=10, max_download=10)
+    (tmp_path / 'a.jpg').write_bytes(b'x' * 10)
+    store.add('a.jpg')
+    os.remove(tmp_path / 'a.jpg')
+
+    assert store.path('a.jpg') is None
+    assert (store.files, store.size) == ({}, 0)
+
+
+def test_concurrent_stores_of_one_url_share_the_work(tmp_path, monkeypatch):
+    store = media.MediaStore(str(tmp_path), max_size=100, max_upload=10, max_download=10)
+    processed = []
+
+    async def process(url, session):
+        processed.append(url)
+        await asyncio.sleep(0.01)
+        (tmp_path / 'a.jpg').write_bytes(b'x')
+        store.add('a.jpg')
+        store.sources[url] = 'a.jpg'
+        return 'a.jpg'
+
+    monkeypatch.setattr(store, 'process', process)
+
+    async def main():
+        names = await asyncio.gather(*(store.store('https://pbs.example/a.jpg', None) for _ in range(5)))
+        return names + [await store.store('https://pbs.example/a.jpg', None)]
+
+    assert asyncio.run(main()) == ['a.jpg'] * 6
+    assert processed == ['https://pbs.example/a.jpg']
+    assert not store.inflight
+
+
+def test_processed_files_are_named_after_their_content(tmp_path):
+    store = media.MediaStore(str(tmp_path / 'cache'), max_size=1000, max_upload=100, max_download=1000)
+    store.executor = ThreadPoolExecutor(1)              # the files fit already, nothing needs a transcoding process
+    content = b'\xff\xd8 small image'
+
+    async def image(request):
+        return web.Response(body=content, content_type='image/jpeg')
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/{name}', image)
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            return [await store.store(str(server.make_url(f'/{name}.jpg')), session) for name in ('a', 'b')]
+
+    try:
+        names = asyncio.run(main())
+    finally:
+        store.shutdown()
+
+    assert names == [hashlib.sha256(content).hexdigest() + '.jpg'] * 2
+    assert list(store.files) == names[:1]
+    assert sorted(os.listdir(tmp_path / 'cache')) == names[:1]        # no downloads left behind
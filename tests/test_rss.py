@@ -0,0 +1,47 @@
+import pytest
+
+import rss
+import utils
+
+
+def nitter_feed(statuses, image=True):
+    items = ''.join(f'''<item><title>status {status}</title><dc:creator>@user</dc:creator>
+<description><![CDATA[<p>status {status}</p>]]></description><pubDate>Mon, 01 Jan 2024 00:00:0{status} GMT</pubDate>
+<link>https://nitter.example/user/status/{status}#m</link></item>''' for status in statuses)
+    image = '<image><title>User / @user</title><url>https://nitter.example/pic/user.jpg</url></image>' if image else ''
+    return f'''<?xml version="1.0" encoding="UTF-8"?>
+<rss xmlns:dc="http://purl.org/dc/elements/1.1/" version="2.0"><channel>
+<title>User / @user</title>{image}{items}</channel></rss>'''.encode('utf-8')
+
+
+def test_parse_nitter_feed():
+    feed = rss.parse(nitter_feed([3, 2, 1]))
+
+    assert feed.feed.title == 'User / @user'
+    assert feed.feed.image.href == 'https://nitter.example/pic/user.jpg'
+    assert [entry.link for entry in feed.entries] == [f'https://nitter.example/user/status/{status}#m' for status in (3, 2, 1)]
+    assert feed.entries[0].author == '@user'
+    assert feed.entries[0].published == 'Mon, 01 Jan 2024 00:00:03 GMT'
+    assert feed.complete
+
+
+def test_parse_stops_at_the_first_known_entry():
+    known = {'https://nitter.example/user/status/2#m'}
+    feed = rss.parse(nitter_feed([4, 3, 2, 1]), is_known=lambda entry: entry.link in known)
+
+    assert [entry.link for entry in feed.entries] == ['https://nitter.example/user/status/4#m', 'https://nitter.example/user/status/3#m']
+    assert not feed.complete
+
+
+def test_parse_rejects_other_documents():
+    with pytest.raises(rss.ParseError):
+        rss.parse(nitter_feed([1], image=False))
+    with pytest.raises(rss.ParseError):
+        rss.parse(b'<html><body>Rate limited</body></html')
+
+
+def test_parse_feed_falls_back_to_feedparser():
+    feed = utils.parse_feed(nitter_feed([2, 1], image=False))
+
+    assert [entry.link for entry in feed.entries] == ['https://nitter.example/user/status/2#m', 'https://nitter.example/user/status/1#m']
+    assert 'image' not in feed.feed
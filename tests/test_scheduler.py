@@ -0,0 +1,102 @@
+import time
+
+import pytest
+
+import scheduler
+import utils
+from handles import HandleBackoff
+from subscriptions import SubscriptionCache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = SubscriptionCache()
+    monkeypatch.setattr(utils, 'subscription_cache', cache)
+    monkeypatch.setattr(utils, 'dead_handles', HandleBackoff())
+    return cache
+
+
+def test_refresh_spreads_the_first_polls_over_the_interval(cache):
+    for i in range(100):
+        cache.add(f'user{i}', 1)
+    polls = scheduler.PollScheduler(600, budget=0)
+    start = time.monotonic()
+    polls.refresh()
+
+    assert len(polls.next_poll) == 100
+    assert all(start <= at <= time.monotonic() + 600 for at in polls.next_poll.values())
+    assert len(polls.pop_due()) < 10
+
+
+def test_accounts_of_a_gained_shard_are_spread_too(cache):
+    for i in range(100):
+        cache.add(f'user{i}', 1)
+    polls = scheduler.PollScheduler(600, budget=0)
+    polls.refresh(owns=lambda username: username == 'user0')
+    polls.refresh()
+
+    assert len(polls.next_poll) == 100
+    assert len(polls.pop_due()) < 10
+
+
+def test_refresh_forgets_accounts_no_longer_owned(cache):
+    cache.add('a', 1)
+    cache.add('b', 1)
+    polls = scheduler.PollScheduler(600, budget=0)
+    polls.refresh()
+    polls.refresh(owns=lambda username: username == 'a')
+
+    assert set(polls.next_poll) == {'a'}
+    assert 'b' not in polls.subscribers
+
+
+def test_newly_followed_accounts_are_polled_right_away(cache):
+    cache.add('old', 1)
+    polls = scheduler.PollScheduler(600, budget=0)
+    polls.refresh()
+    cache.add('new', 1)
+    cache.add('new', 2)
+    polls.add('new')
+
+    assert polls.pop_due() == ['new']
+    assert polls.subscribers['new'] == 2
+
+
+def test_the_budget_caps_polls_per_minute(cache):
+    polls = scheduler.PollScheduler(600, budget=3)
+    for i in range(10):
+        polls.schedule(f'user{i}', 0)
+
+    assert len(polls.pop_due()) == 3
+    assert polls.pop_due() == []
+
+
+def test_rescheduled_and_forgotten_accounts_are_skipped(cache):
+    polls = scheduler.PollScheduler(600, budget=0)
+    polls.schedule('moved', 0)
+    polls.schedule('moved', time.monotonic() + 600)
+    polls.schedule('gone', 0)
+    polls.forget('gone')
+
+    assert polls.pop_due() == []
+
+
+def test_record_polls_busy_accounts_more_often(cache):
+    polls = scheduler.PollScheduler(600, budget=0)
+    for username in ('busy', 'quiet'):
+        polls.schedule(username, 0)
+    due = polls.pop_due()
+    polls.record(due, {'busy': 10})
+
+    assert polls.next_poll['busy'] < polls.next_poll['quiet']
+    assert polls.next_interval('busy') >= 600 * utils.POLL_MIN_INTERVAL
+    assert polls.next_interval('quiet') <= 600 * utils.POLL_MAX_INTERVAL
+
+
+def test_record_waits_for_backing_off_accounts(cache):
+    utils.dead_handles.failure('missing')
+    polls = scheduler.PollScheduler(1, budget=0)
+    polls.schedule('missing', 0)
+    polls.record(polls.pop_due(), {})
+
+    assert polls.next_poll['missing'] >= utils.dead_handles.retry_at('missing')
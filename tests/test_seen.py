@@ -0,0 +1,38 @@
+from feedparser import FeedParserDict
+
+import utils
+
+
+def entry(status, host='nitter.example'):
+    return FeedParserDict(link=f'https://{host}/user/status/{status}#m', published='Mon, 01 Jan 2024 00:00:00 GMT')
+
+
+def test_entry_id_ignores_the_nitter_host():
+    assert utils.entry_id(entry(1, 'nitter.one')) == utils.entry_id(entry(1, 'nitter.two'))
+    assert utils.entry_id(entry(1)) != utils.entry_id(entry(2))
+    assert len(utils.entry_id(entry(1))) == utils.ENTRY_ID_SIZE
+
+
+def test_advance_seen_puts_the_current_feed_first():
+    old = utils.advance_seen(None, [utils.entry_id(entry(status)) for status in (2, 1)])
+    new = utils.advance_seen(old, [utils.entry_id(entry(status)) for status in (3, 2)])
+
+    ids = [new[i:i + utils.ENTRY_ID_SIZE] for i in range(0, len(new), utils.ENTRY_ID_SIZE)]
+    assert ids == [utils.entry_id(entry(status)) for status in (3, 2, 1)]
+    assert utils.load_seen(new) == set(ids)
+
+
+def test_advance_seen_drops_the_oldest_ids(monkeypatch):
+    monkeypatch.setattr(utils, 'SEEN_INDEX_SIZE', 3)
+    seen = utils.advance_seen(None, [utils.entry_id(entry(status)) for status in (3, 2, 1)])
+    seen = utils.advance_seen(seen, [utils.entry_id(entry(5)), utils.entry_id(entry(4))])
+
+    assert utils.load_seen(seen) == {utils.entry_id(entry(status)) for status in (5, 4, 3)}
+
+
+def test_entries_since_hash():
+    entries = [entry(status) for status in (3, 2, 1)]
+
+    assert utils.entries_since_hash(entries, utils.create_hash(entries[1])) == entries[:1]
+    assert utils.entries_since_hash(entries, utils.create_hash(entries[0])) == []
+    assert utils.entries_since_hash(entries, 'unknown') == entries[:1]      # only the latest tweet
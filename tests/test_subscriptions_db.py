@@ -0,0 +1,79 @@
+'''Tests against a real Postgres. TEST_DB_NAME names a scratch database that is dropped and created again,
+DB_HOST, DB_PORT, DB_USER and DB_PASS are read as for the bot. Skipped when TEST_DB_NAME isn't set'''
+
+import asyncio
+import os
+from types import SimpleNamespace
+
+import asyncpg
+import pytest
+
+import utils
+from subscriptions import SubscriptionCache
+
+
+TEST_DB_NAME = os.getenv('TEST_DB_NAME')
+
+pytestmark = pytest.mark.skipif(not TEST_DB_NAME, reason='TEST_DB_NAME is not set')
+
+
+@pytest.fixture
+def database(monkeypatch):
+    '''Runs a coroutine function against a freshly migrated scratch database'''
+    monkeypatch.setattr(utils, 'DB_NAME', TEST_DB_NAME)
+    monkeypatch.setattr(utils, 'subscription_cache', SubscriptionCache())
+
+    async def recreate():
+        conn = await asyncpg.connect(host=utils.DB_HOST, port=utils.DB_PORT, user=utils.DB_USER,
+                                     password=utils.DB_PASS, database='postgres')
+        try:
+            await conn.execute(f'DROP DATABASE IF EXISTS "{TEST_DB_NAME}"')
+            await conn.execute(f'CREATE DATABASE "{TEST_DB_NAME}"')
+        finally:
+            await conn.close()
+
+    def run(test):
+        async def main():
+            await recreate()
+            await utils.init_pool()
+            try:
+                await test()
+            finally:
+                await utils.close_pool()
+        asyncio.run(main())
+
+    return run
+
+
+def channel(channel_id):
+    return SimpleNamespace(id=channel_id, name=f'channel{channel_id}', guild=SimpleNamespace(id=1, name='guild'))
+
+
+def test_resubscribing_an_orphaned_account_starts_from_the_current_feed(database):
+    async def test():
+        for channel_id in (10, 20):
+            utils.subscription_cache.set_webhook(channel_id, channel_id, 'token')
+        async with utils.pool.acquire() as conn:
+            await utils.add_subscriptions([('user', 'old hash', b'old seen')], channel(10), conn)
+            await utils.remove_sub('user', channel(10), conn)           # the twitterUsers row stays until sanity_check
+            await utils.add_subscriptions([('user', 'new hash', b'new seen')], channel(20), conn)
+            row = await conn.fetchrow('SELECT "hash", "seen" FROM twitterUsers WHERE "username" = $1', 'user')
+
+        assert (row['hash'], row['seen']) == ('new hash', b'new seen')
+
+    database(test)
+
+
+def test_subscribing_a_followed_account_keeps_its_seen_index(database):
+    async def test():
+        for channel_id in (10, 20):
+            utils.subscription_cache.set_webhook(channel_id, channel_id, 'token')
+        async with utils.pool.acquire() as conn:
+            await utils.add_subscriptions([('user', 'old hash', b'old seen')], channel(10), conn)
+            added = await utils.add_subscriptions([('user', 'new hash', b'new seen')], channel(20), conn)
+            row = await conn.fetchrow('SELECT "hash", "seen" FROM twitterUsers WHERE "username" = $1', 'user')
+
+        assert added == {'user'}
+        assert (row['hash'], row['seen']) == ('old hash', b'old seen')     # the poller owns it while anyone follows
+
+    database(test)
@@ -0,0 +1,157 @@
+import asyncio
+import contextlib
+
+import pytest
+from feedparser import FeedParserDict
+
+import utils
+from subscriptions import SubscriptionCache
+
+
+def make_feed(username, statuses):
+    entries = [FeedParserDict(title=f'Status {status}', link=f'https://nitter.example/{username}/status/{status}#m',
+                              published='Mon, 01 Jan 2024 00:00:00 GMT', author=f'@{username}')
+               for status in statuses]
+    return FeedParserDict(feed=FeedParserDict(title=f'Name @{username}', image=FeedParserDict(href='https://pbs.example/a.jpg')),
+                          entries=entries, complete=True)
+
+
+class FakeConnection:
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+
+class FakePool:
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection()
+
+
+@pytest.fixture
+def cycle(monkeypatch):
+    '''Runs get_updates against fake feeds and a fake database, recording what is committed'''
+
+    state = {'feeds': {}, 'seen': {}, 'fail_commit': set(), 'committed': [], 'queued': []}
+    cache = SubscriptionCache()
+
+    async def fetch_user_hash_lists(conn, usernames):
+        return [(username, None, state['seen'].get(username)) for username in usernames]
+
+    async def fetch_feed(username, session, poll=False, is_known=None):
+        feed = state['feeds'][username]
+        if isinstance(feed, Exception):
+            raise feed
+        return (feed, True)
+
+    async def update_hashes(new_hashes, conn):
+        if {username for (username, _, _) in new_hashes} & state['fail_commit']:
+            raise OSError('connection lost')
+        state['committed'].extend(new_hashes)
+
+    async def queue_deliveries(deliveries, conn):
+        state['queued'].extend(deliveries)
+
+    monkeypatch.setattr(utils, 'pool', FakePool())
+    monkeypatch.setattr(utils, 'subscription_cache', cache)
+    monkeypatch.setattr(utils, 'fetch_user_hash_lists', fetch_user_hash_lists)
+    monkeypatch.setattr(utils, 'fetch_feed', fetch_feed)
+    monkeypatch.setattr(utils, 'update_hashes', update_hashes)
+    monkeypatch.setattr(utils, 'queue_deliveries', queue_deliveries)
+    monkeypatch.setattr(utils, 'UPDATE_COMMIT_BATCH', 1)
+
+    def run(usernames, on_commit=None):
+        for username in usernames:
+            cache.add(username, 1)
+        return asyncio.run(asyncio.wait_for(utils.get_updates(usernames, on_commit), 5))
+
+    state['run'] = run
+    return state
+
+
+def test_every_feed_goes_through_all_stages(cycle):
+    usernames = [f'user{i}' for i in range(30)]
+    for username in usernames:
+        cycle['feeds'][username] = make_feed(username, [3, 2, 1])
+    commits = []
+
+    (new_counts, queued) = cycle['run'](usernames, on_commit=lambda: commits.append(1))
+
+    assert new_counts == {username: 1 for username in usernames}       # no seen index yet, only the newest tweet
+    assert queued == 30 and len(cycle['queued']) == 30
+    assert commits
+    assert not utils.update_lock.locked()
+
+
+def test_bad_feeds_dont_stop_the_cycle(cycle):
+    no_image = make_feed('noimage', [2, 1])
+    del no_image.feed['image']                                  # like feeds parsed by the feedparser fallback
+    broken = make_feed('broken', [2, 1])
+    broken.entries[0]['published'] = 'not a date'
+    cycle['feeds'].update(noimage=no_image, broken=broken, failing=OSError('boom'), good=make_feed('good', [1]))
+
+    (new_counts, queued) = cycle['run'](['noimage', 'broken', 'failing', 'good'])
+
+    assert new_counts == {'noimage': 1, 'good': 1}
+    assert queued == 2
+    assert [avatar_url for (_, _, _, avatar_url, _) in cycle['queued'] if avatar_url is None] == [None]
+
+
+def test_every_diff_worker_sees_the_end_of_the_feeds(cycle, monkeypatch):
+    async def entry_media(entry):
+        await asyncio.sleep(0)
+        return None
+
+    monkeypatch.setattr(utils, 'media_store', object())                # runs MEDIA_CONCURRENCY diff workers
+    monkeypatch.setattr(utils, 'entry_media', entry_media)
+    monkeypatch.setattr(utils, 'MEDIA_CONCURRENCY', 4)
+    monkeypatch.setattr(utils, 'UPDATE_QUEUE_SIZE', 1)
+    usernames = [f'user{i}' for i in range(20)]
+    for username in usernames:
+        cycle['feeds'][username] = make_feed(username, [1])
+
+    (new_counts, queued) = cycle['run'](usernames)
+
+    assert set(new_counts) == set(usernames)
+    assert queued == 20
+
+
+def test_empty_and_unchanged_feeds_are_not_committed(cycle):
+    cycle['feeds']['empty'] = make_feed('empty', [])
+    cycle['feeds']['unchanged'] = make_feed('unchanged', [2, 1])
+    cycle['seen']['unchanged'] = utils.advance_seen(None, [utils.entry_id(entry) for entry in cycle['feeds']['unchanged'].entries])
+
+    assert cycle['run'](['empty', 'unchanged']) == ({}, 0)
+    assert cycle['committed'] == []
+
+
+def test_a_failing_stage_stops_the_others(cycle, monkeypatch):
+    monkeypatch.setattr(utils, 'UPDATE_QUEUE_SIZE', 1)
+    usernames = [f'user{i}' for i in range(20)]
+    for username in usernames:
+        cycle['feeds'][username] = make_feed(username, [1])
+
+    def on_commit():
+        raise RuntimeError('worker gone')
+
+    with pytest.raises(RuntimeError):
+        cycle['run'](usernames, on_commit=on_commit)        # times out instead when a stage stays blocked on its queue
+    assert not utils.update_lock.locked()
+
+
+def test_failed_commit_is_polled_again(cycle):
+    cycle['feeds']['good'] = make_feed('good', [2, 1])
+    cycle['feeds']['lost'] = make_feed('lost', [2, 1])
+    cycle['fail_commit'].add('lost')
+    for instance in utils.nitter_instances.instances:
+        utils.cache_feed(utils.feed_url(instance, 'lost'), '"etag"', None, None, False)
+        utils.cache_feed(utils.feed_url(instance, 'good'), '"etag"', None, None, False)
+
+    (new_counts, _) = cycle['run'](['good', 'lost'])
+
+    assert new_counts == {'good': 1}
+    assert [username for (username, _, _) in cycle['committed']] == ['good']
+    for instance in utils.nitter_instances.instances:
+        assert utils.feed_url(instance, 'lost') not in utils.feed_cache
+        assert utils.feed_url(instance, 'good') in utils.feed_cache
@@ -1,4 +1,6 @@
 import feedparser
+import asyncio
+import aiohttp
 from datetime import datetime
 import pytz
 from urllib.parse import urlparse
@@ -7,8 +9,19 @@ import asyncpg
 import os
 import hashlib
 import logging
+import time
+import socket
+from collections import OrderedDict
 from dotenv import load_dotenv
 
+import handles
+import instances
+import latest
+import media
+import metrics
+import rss
+from subscriptions import SubscriptionCache
+
 load_dotenv()
 
 # Variables
@@ -16,10 +29,92 @@ load_dotenv()
 DB_USER = os.getenv('DB_USER')
 DB_PASS = os.getenv('DB_PASS')
 DB_NAME = os.getenv('DB_NAME')
+DB_HOST = os.getenv('DB_HOST', 'postgres')
+DB_PORT = int(os.getenv('DB_PORT', 5432))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', 100))   # prepared statements kept per connection
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
 UPDATE_INTERVAL = os.getenv('UPDATE_INTERVAL')
 
+NITTER_INSTANCES = os.getenv('NITTER_INSTANCES', 'https://nitter.woodland.cafe').split(',')
+INSTANCE_MAX_FAILURES = int(os.getenv('INSTANCE_MAX_FAILURES', 3))  # consecutive failures before a cooldown
+INSTANCE_COOLDOWN = int(os.getenv('INSTANCE_COOLDOWN', 300))        # seconds a failing instance is skipped
+FEED_ATTEMPTS = int(os.getenv('FEED_ATTEMPTS', 3))                  # instances tried per feed
+
+FEED_CONCURRENCY = int(os.getenv('FEED_CONCURRENCY', 20))      # max feed requests in flight
+FEED_TIMEOUT = float(os.getenv('FEED_TIMEOUT', 15))             # seconds per feed request
+
+FEED_CACHE_SIZE = int(os.getenv('FEED_CACHE_SIZE', 5000))      # max feeds kept for conditional requests
+LATEST_FEEDS_SIZE = int(os.getenv('LATEST_FEEDS_SIZE', 1000))  # max parsed feeds kept for /tweet and /subscription add
+LATEST_FEEDS_TTL = int(os.getenv('LATEST_FEEDS_TTL', 120))     # seconds a parsed feed is served without fetching it again
+DEAD_HANDLES_SIZE = int(os.getenv('DEAD_HANDLES_SIZE', 10000))       # max missing or empty accounts remembered
+DEAD_HANDLE_BACKOFF = int(os.getenv('DEAD_HANDLE_BACKOFF', 300))     # seconds before such an account is fetched again,
+DEAD_HANDLE_MAX_BACKOFF = int(os.getenv('DEAD_HANDLE_MAX_BACKOFF', 21600))  # doubled on every failure up to this
+
+HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', 100))                      # open connections of the shared HTTP session
+HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', 30))     # open connections per host, 0 for no limit
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', 60))             # seconds an idle connection is kept open
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', 300))                  # seconds a DNS lookup is cached
+
+DISCORD_API_BASE = os.getenv('DISCORD_API_BASE', 'https://discord.com/api/v10')
+DELIVERY_CONCURRENCY = int(os.getenv('DELIVERY_CONCURRENCY', 10))  # max webhook requests in flight
+DELIVERY_TIMEOUT = float(os.getenv('DELIVERY_TIMEOUT', 15))         # seconds per webhook request
+DELIVERY_RETRIES = int(os.getenv('DELIVERY_RETRIES', 5))            # attempts per message on 429 / 5xx
+OUTBOX_BATCH = int(os.getenv('OUTBOX_BATCH', 100))                  # outbox rows claimed at a time
+OUTBOX_VISIBILITY = int(os.getenv('OUTBOX_VISIBILITY', 300))        # seconds claimed rows stay hidden from other workers
+OUTBOX_RETRY_BASE = int(os.getenv('OUTBOX_RETRY_BASE', 15))         # seconds before the first retry, doubled every attempt
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))     # attempts before a message is dropped
+OUTBOX_POLL_INTERVAL = int(os.getenv('OUTBOX_POLL_INTERVAL', 30))   # seconds between outbox checks when idle
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))                 # 0 turns the /metrics endpoint off
+
+BATCH_MODE = os.getenv('BATCH_MODE', 'off')                        # off, account or channel
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 5))             # tweets per batched message
+
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+POLL_SHARDS = int(os.getenv('POLL_SHARDS', 16))                    # lease shards the tracked accounts are split into
+LEASE_TTL = int(os.getenv('LEASE_TTL', 60))                         # seconds a poll lease lasts without renewal
+
+DISCORD_SHARD_ID = os.getenv('DISCORD_SHARD_ID')                    # gateway sharding, when several processes share the token
+DISCORD_SHARD_COUNT = os.getenv('DISCORD_SHARD_COUNT')
+
+SCHEDULER_TICK = int(os.getenv('SCHEDULER_TICK', 15))              # seconds between scheduler runs
+POLL_BUDGET = int(os.getenv('POLL_BUDGET', 0))                      # max feed polls per minute, 0 for no limit
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', 0.25))     # fastest and slowest poll of one account,
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', 4))        # as multiples of UPDATE_INTERVAL
+
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', 100))       # feeds waiting between two stages of an update cycle
+UPDATE_COMMIT_BATCH = int(os.getenv('UPDATE_COMMIT_BATCH', 50))    # max feeds written to the outbox in one transaction
+
+SEEN_INDEX_SIZE = int(os.getenv('SEEN_INDEX_SIZE', 64))            # entry ids remembered per user
+ENTRY_ID_SIZE = 8                                                   # bytes per entry id in the seen index
+
+MEDIA_UPLOADS = os.getenv('MEDIA_UPLOADS', 'off') == 'on'          # upload tweet images and videos with the link
+MEDIA_CACHE_DIR = os.getenv('MEDIA_CACHE_DIR', 'media-cache')
+MEDIA_CACHE_SIZE = int(os.getenv('MEDIA_CACHE_SIZE', 1024)) * 2 ** 20      # MB of processed media kept on disk
+MEDIA_MAX_UPLOAD = int(os.getenv('MEDIA_MAX_UPLOAD', 10)) * 2 ** 20        # MB per file Discord accepts from the webhook
+MEDIA_MAX_DOWNLOAD = int(os.getenv('MEDIA_MAX_DOWNLOAD', 100)) * 2 ** 20   # MB per file downloaded before giving up
+MEDIA_MAX_DIMENSION = int(os.getenv('MEDIA_MAX_DIMENSION', 2048))          # pixels, for shrunk images and videos
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 0)) or None                 # transcoding processes, 0 for one per CPU
+MEDIA_CONCURRENCY = int(os.getenv('MEDIA_CONCURRENCY', 4))                 # feeds whose media are processed at once
+
+MESSAGE_MAX_LENGTH = 2000                                           # Discord limits for one message
+MESSAGE_MAX_EMBEDS = 10
+
+feed_semaphore = asyncio.Semaphore(FEED_CONCURRENCY)
+subscription_cache = SubscriptionCache()
+nitter_instances = instances.InstancePool([url.strip() for url in NITTER_INSTANCES if url.strip()],
+                                          max_failures=INSTANCE_MAX_FAILURES, cooldown=INSTANCE_COOLDOWN)
+
+# url -> (etag, last_modified, parsed feed, unseen by the poller)
+feed_cache = OrderedDict()
+latest_feeds = latest.LatestFeeds(LATEST_FEEDS_SIZE, LATEST_FEEDS_TTL)
+dead_handles = handles.HandleBackoff(DEAD_HANDLES_SIZE, DEAD_HANDLE_BACKOFF, DEAD_HANDLE_MAX_BACKOFF)
+media_store = media.MediaStore(MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE, MEDIA_MAX_UPLOAD, MEDIA_MAX_DOWNLOAD,
+                               MEDIA_MAX_DIMENSION, MEDIA_WORKERS) if MEDIA_UPLOADS else None
+
 
 #Setting up loggers
 
@@ -47,26 +142,117 @@ logger.addHandler(console_handler)
 
 # Secondary Functions
 
-async def create_connection():
-    try:
-        conn = await asyncpg.connect(
-            host='postgres',
-            port=5432,
-            user=DB_USER,
-            password=DB_PASS,
-            database=DB_NAME
-        )
-        db_logger.debug("┌ Connection to Database Successful")
-        return conn
-    except Exception as e:
-        db_logger.error(f"Error connecting to the database: {e}")
-        return None
-    
-
-async def close_connection(conn):
-    if conn:
-        await conn.close()
-        db_logger.debug('└ Disconnected from the Database Successfully')
+pool = None
+
+async def init_pool():
+    '''Creates the application-wide connection pool. Pooled connections live for the whole process,
+    so every query is prepared once per connection and then served from its statement cache'''
+    global pool
+    if pool:
+        return
+    pool = await asyncpg.create_pool(
+        host=DB_HOST,
+        port=DB_PORT,
+        user=DB_USER,
+        password=DB_PASS,
+        database=DB_NAME,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        statement_cache_size=DB_STATEMENT_CACHE
+    )
+    db_logger.debug(f"┌ Connection pool to Database created ({DB_POOL_MIN}-{DB_POOL_MAX} connections)")
+    await migrate()
+    await check_indexes()
+
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_LOCK = 0x7477696e78                   # advisory lock key, so only one process migrates at a time
+
+async def migrate():
+    '''Applies the migrations/NNN_name.sql files the database doesn't have yet, in order and each in its own transaction.
+    Applied versions are recorded in schema_migrations, so existing volumes are upgraded in place'''
+    migrations = sorted((int(filename.split('_', 1)[0]), filename) for filename in os.listdir(MIGRATIONS_DIR) if filename.endswith('.sql'))
+
+    async with pool.acquire() as conn:
+        await conn.execute('SELECT pg_advisory_lock($1)', MIGRATION_LOCK)
+        try:
+            await conn.execute('''CREATE TABLE IF NOT EXISTS schema_migrations (
+                                      "version" INT NOT NULL PRIMARY KEY,
+                                      "name" TEXT NOT NULL,
+                                      "appliedAt" TIMESTAMPTZ NOT NULL DEFAULT now())''')
+            applied = {row['version'] for row in await conn.fetch('SELECT "version" FROM schema_migrations')}
+
+            for (version, filename) in migrations:
+                if version in applied:
+                    continue
+                with open(os.path.join(MIGRATIONS_DIR, filename)) as f:
+                    statements = f.read()
+                async with conn.transaction():
+                    await conn.execute(statements)
+                    await conn.execute('INSERT INTO schema_migrations ("version", "name") VALUES ($1, $2)', version, filename)
+                db_logger.debug(f"├ Applied migration {filename}")
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK)
+
+
+# Queries that must not scan a whole table once the tables grow, with the index each one relies on and sample arguments
+REMOVE_CHANNEL_SUBS = 'DELETE FROM subs WHERE "channelId" = ($1)'
+
+INDEXED_QUERIES = {
+    REMOVE_CHANNEL_SUBS: ('subs_channel_id', (0,)),
+}
+
+# Foreign keys without an index leading with their columns, ON DELETE CASCADE would scan the referencing table
+UNINDEXED_FOREIGN_KEYS = '''SELECT conrelid::regclass::text AS "table", conname AS "constraint" FROM pg_constraint
+                            WHERE contype = 'f' AND connamespace = current_schema()::regnamespace AND NOT EXISTS (
+                                SELECT 1 FROM pg_index WHERE indrelid = conrelid
+                                AND (string_to_array(indkey::text, ' ')::int2[])[1:cardinality(conkey)] @> conkey)'''
+
+async def check_indexes():
+    '''EXPLAINs the queries keyed by something else than a primary key and warns about the ones that would not use their index,
+    then warns about the foreign keys whose cascades have no index to go through.
+    Sequential scans are turned off for the check, as the planner rightly prefers them while the tables are small'''
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute('SET LOCAL enable_seqscan = off')
+            for (query, (index, args)) in INDEXED_QUERIES.items():
+                plan = '\n'.join(row[0] for row in await conn.fetch(f'EXPLAIN {query}', *args))
+                if index not in plan:
+                    db_logger.warning(f"Query '{query}' does not use the index {index}:\n{plan}")
+        for row in await conn.fetch(UNINDEXED_FOREIGN_KEYS):
+            db_logger.warning(f"Foreign key {row['constraint']} of {row['table']} has no index, deletes cascading to it scan the table")
+
+
+async def close_pool():
+    global pool
+    if pool:
+        await pool.close()
+        pool = None
+        db_logger.debug('└ Connection pool to Database closed')
+
+
+http_session = None
+
+async def init_session():
+    '''Creates the process-wide HTTP session used for Nitter and Discord, so connections, TLS sessions
+    and DNS lookups are reused across update cycles and commands'''
+    global http_session
+    if http_session:
+        return
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_TTL
+    )
+    http_session = aiohttp.ClientSession(connector=connector)
+
+
+async def close_session():
+    global http_session
+    if http_session:
+        await http_session.close()
+        http_session = None
 
 
 def create_timestamp(pubTime):
@@ -102,245 +288,410 @@ def create_hash(feed_dict):
     return hashlib.sha256((feed_dict.published + feed_dict.link).encode('utf-8')).hexdigest()
 
 
-async def create_webhook(channel):
-    webhook = await channel.create_webhook(name='Twinx')
-    info_logger.debug(f'New webhook created for {channel.guild.name} in #{channel.name}')
-    webhook_id = webhook.id
-    webhook_token = webhook.token
-    return (webhook_id, webhook_token)
+def entry_id(feed_dict):
+    '''Compact id of a feed entry. It is taken from the status path so it doesn't change with the Nitter host'''
+    return hashlib.sha256(urlparse(feed_dict.link).path.encode('utf-8')).digest()[:ENTRY_ID_SIZE]
 
 
-# Database Query Functions
+def load_seen(seen):
+    '''Splits the stored seen index into a set of entry ids'''
+    return {seen[i:i + ENTRY_ID_SIZE] for i in range(0, len(seen), ENTRY_ID_SIZE)}
 
-async def fetch_webhook_details(conn, channel_id):
-    result = await conn.fetch('SELECT "webhookId", "webhookToken" FROM channels WHERE "channelId" = $1', channel_id)
-    return result
 
+def advance_seen(seen, entry_ids):
+    '''Puts the ids of the current feed in front of the seen index and drops the oldest ones past SEEN_INDEX_SIZE'''
+    current = set(entry_ids)
+    ring = list(entry_ids)
+    for i in range(0, len(seen or b''), ENTRY_ID_SIZE):
+        if seen[i:i + ENTRY_ID_SIZE] not in current:
+            ring.append(seen[i:i + ENTRY_ID_SIZE])
+    return b''.join(ring[:SEEN_INDEX_SIZE])
 
-async def fetch_subbed_webhook_details(conn, username):
-    result = await conn.fetch('SELECT "webhookId", "webhookToken", channels."channelId" FROM subs JOIN channels ON subs."channelId" = channels."channelId" where subs."username" = ($1)', username)
-    return result
 
+def entries_since_hash(entries, stored_hash):
+    '''Old detection through the single stored hash, used until a user has a seen index'''
+    for i in range(len(entries)):
+        if create_hash(entries[i]) == stored_hash:
+            return entries[:i]
+    return entries[:1]                                              # for sending just the latest tweet if no matching hash found
 
-async def fetch_guild_lists(conn):
-    result = await conn.fetch('SELECT "guildId" FROM guilds') 
-    return result
 
+class InstanceError(Exception):
+    pass
 
-async def fetch_user_lists(conn):
-    result = await conn.fetch('SELECT "username" FROM twitterUsers') 
-    return result
 
+class HandleNotFound(Exception):
+    pass
 
-async def fetch_user_hash_lists(conn):
-    result = await conn.fetch('SELECT "username", "hash" FROM twitterUsers') 
-    return result
 
+def cache_feed(url, etag, last_modified, feed, unseen):
+    feed_cache[url] = (etag, last_modified, feed, unseen)
+    feed_cache.move_to_end(url)
+    while len(feed_cache) > FEED_CACHE_SIZE:
+        feed_cache.popitem(last=False)
 
-async def fetch_subscribed_users(conn):
-    result = await conn.fetch('SELECT DISTINCT "username" FROM subs')
-    return result
 
+def feed_url(instance, username):
+    return f'{instance.base_url}/{username}/with_replies/rss'
 
-async def fetch_subbed_users_by_channel(channel_id):
-    conn = await create_connection()
-    result = await conn.fetch('SELECT DISTINCT "username" FROM subs where "channelId" = $1', channel_id)
-    await close_connection(conn)
-    users = [user[0] for user in result]
-    return users
 
+def forget_feed(username):
+    '''Drops the cached validators of the user's feed on every instance, so the next poll downloads it again
+    instead of getting a 304 for tweets that never made it to the outbox'''
+    for instance in nitter_instances.instances:
+        feed_cache.pop(feed_url(instance, username), None)
 
-async def update_webhook(channel):
-    webhook = await channel.create_webhook(name='Twinx')
-    webhook_id = webhook.id
-    webhook_token = webhook.token
 
-    conn = await create_connection()
+def parse_feed(body, is_known=None):
+    '''Parses with the streaming Nitter parser and falls back to feedparser for documents it doesn't understand'''
     try:
-        await conn.execute('UPDATE channels SET "webhookId" = $1, "webhookToken" = $2 WHERE "channelId" = $3', webhook_id, webhook_token, channel.id)
-        info_logger.debug(f"Old webhook replaced by a new one for guild '{channel.guild.name}' in #{channel.name}")
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
-        
-    await close_connection(conn)
-
-    return (webhook_id, webhook_token)
-
-
-async def update_hash(username, new_hash, conn):
-    try:
-        await conn.execute('UPDATE twitterUsers SET "hash" = $1 WHERE "username" = $2', new_hash, username)
-        info_logger.debug(f'Hash updated for @{username}')
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
-
-
-async def username_in_db(new_user, conn):
+        return rss.parse(body, is_known)
+    except rss.ParseError:
+        return feedparser.parse(body)
+
+
+async def fetch_feed(username, session, poll=False, is_known=None):
+    '''Fetches the user's feed from the healthiest Nitter instances, moving on to the next one when an instance fails.
+    With is_known the feed is only parsed up to the first entry it accepts.
+    Returns (feed, modified) where modified is False when the poller has already seen this feed.
+    Every feed fetched goes into latest_feeds, missing and empty feeds put the account in dead_handles'''
+
+    for instance in nitter_instances.ranked()[:FEED_ATTEMPTS]:
+        try:
+            (feed, modified) = await fetch_from_instance(instance, feed_url(instance, username), session, poll, is_known)
+        except InstanceError as e:
+            logger.warning(f"{e}, trying the next instance")
+            continue
+        except HandleNotFound:
+            dead_handles.failure(username)
+            return (None, False)
+        if feed and feed.entries:
+            latest_feeds.put(username, feed)
+            dead_handles.success(username)
+        elif feed and not feed.get('complete', True):               # nothing new, the cached newest entry still is
+            latest_feeds.touch(username)
+            dead_handles.success(username)
+        elif feed:                                                  # suspended or never posted
+            dead_handles.failure(username)
+        return (feed, modified)
+
+    logger.error(f"Error fetching the feed of @{username}: no instance answered")
+    return (None, False)
+
+
+async def get_feed(username):
+    '''The user's feed from latest_feeds, fetched once for all concurrent callers when it isn't cached.
+    Accounts backing off in dead_handles aren't fetched at all'''
+    if dead_handles.blocked(username):
+        return None
+    return await latest_feeds.get_or_fetch(username, load_feed)
 
-    usernames = await conn.fetch('SELECT "username" FROM twitterUsers') 
 
-    for username in usernames:
-        if new_user == username[0]:
-            return True
-    return False
+async def load_feed(username):
+    (feed, _) = await fetch_feed(username, http_session)
+    return feed
 
 
-async def guild_in_db(new_guild_id, conn):
+async def fetch_from_instance(instance, url, session, poll, is_known):
+    '''Downloads the feed without blocking the event loop and parses it on a worker thread.
+    Cached ETag / Last-Modified validators are sent along, and a 304 reply reuses the cached feed.
+    Feeds the poller only parsed in part are cached without their content, so only the poller revalidates them'''
 
-    guilds = await conn.fetch('SELECT "guildId" FROM guilds') 
+    headers = {'User-Agent': feedparser.USER_AGENT}
+    cached = feed_cache.get(url)
+    if cached and not poll and cached[2] is None:
+        cached = None
+    if cached:
+        (etag, last_modified, cached_feed, unseen) = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
 
-    for guild_id in guilds:
-        if new_guild_id == guild_id[0]:
-            return True
-    return False
+    try:
+        async with feed_semaphore:
+            start = time.monotonic()
+            async with session.get(url, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(total=FEED_TIMEOUT)) as response:
+                if response.status == 304 and cached:
+                    nitter_instances.success(instance, time.monotonic() - start)
+                    metrics.feed_fetch_seconds.observe(time.monotonic() - start)
+                    metrics.feed_responses.inc(status=304)
+                    if poll:
+                        cache_feed(url, etag, last_modified, cached_feed, False)
+                    else:
+                        feed_cache.move_to_end(url)
+                    return (cached_feed, unseen or not poll)
+                if response.status == 404:                          # the instance is fine, the user doesn't exist
+                    nitter_instances.success(instance, time.monotonic() - start)
+                    metrics.feed_responses.inc(status=404)
+                    raise HandleNotFound(url)
+                if response.status != 200:
+                    raise InstanceError(f"Feed request for {url} returned status {response.status}")
+                body = await response.read()
+                latency = time.monotonic() - start
+                metrics.feed_fetch_seconds.observe(latency)
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+    except (aiohttp.ClientError, asyncio.TimeoutError, InstanceError) as e:
+        metrics.feed_responses.inc(status='error')
+        if nitter_instances.failure(instance):
+            logger.warning(f"Nitter instance {instance.base_url} is failing, cooling down for {INSTANCE_COOLDOWN}s")
+        raise InstanceError(e if isinstance(e, InstanceError) else f"Error fetching the feed {url}: {e!r}")
+
+    with metrics.feed_parse_seconds.time():
+        feed = await asyncio.to_thread(parse_feed, body, is_known)
+
+    if not feed.entries and not feed.feed.get('title'):            # an error page instead of a feed
+        nitter_instances.failure(instance)
+        metrics.feed_responses.inc(status='error')
+        raise InstanceError(f"Feed request for {url} did not return a feed")
+    nitter_instances.success(instance, latency)
+    metrics.feed_responses.inc(status=200)
+
+    if (feed.entries or not feed.get('complete', True)) and (etag or last_modified):
+        cache_feed(url, etag, last_modified, feed if feed.get('complete', True) else None, not poll)
+    else:
+        feed_cache.pop(url, None)
 
+    return (feed, True)
 
-async def channel_in_db(new_channel_id, conn):
 
-    channels = await conn.fetch('SELECT "channelId" FROM channels') 
+async def create_webhook(channel):
+    webhook = await channel.create_webhook(name='Twinx')
+    info_logger.debug(f'New webhook created for {channel.guild.name} in #{channel.name}')
+    webhook_id = webhook.id
+    webhook_token = webhook.token
+    return (webhook_id, webhook_token)
 
-    for channel_id in channels:
-        if new_channel_id == channel_id[0]:
-            return True
-    return False
 
+async def delete_webhook(webhook_id, webhook_token):
+    '''Deletes a webhook that never made it into the database, so it isn't left behind in the channel'''
+    try:
+        await discord.Webhook.partial(webhook_id, webhook_token, session=http_session).delete()
+    except Exception as e:
+        logger.warning(f"Error deleting the unused webhook {webhook_id}: {e}")
 
-async def sub_in_db(username, channel_id, conn):
 
-    subs = await conn.fetch('SELECT "username", "channelId" FROM subs')
+# Database Query Functions
 
-    for sub in subs:
-        if (username, channel_id) == sub:
-            return True
-    return False
+async def fetch_webhook_details(conn, channel_id):
+    result = await conn.fetch('SELECT "webhookId", "webhookToken" FROM channels WHERE "channelId" = $1', channel_id)
+    return result
 
 
-async def channel_in_sub(channel_id, conn):            # Redundant, but will keep this for now
+async def fetch_user_hash_lists(conn, usernames):
+    result = await conn.fetch('SELECT "username", "hash", "seen" FROM twitterUsers WHERE "username" = ANY($1::text[])', usernames)
+    return result
 
-    channels = await conn.fetch('SELECT "channelId" FROM subs')
 
-    for channel in channels:
-        if channel_id == channel[0]:
-            return True
-    return False
+async def load_subscriptions():
+    '''Fills the in-memory subscription cache from one consistent snapshot of the database'''
+    async with pool.acquire() as conn:
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            channels = await conn.fetch('SELECT "channelId", "webhookId", "webhookToken" FROM channels')
+            subs = await conn.fetch('SELECT "username", "channelId" FROM subs')
+    subscription_cache.load(channels, subs)
+    info_logger.debug(f"Subscription cache loaded with {len(subs)} subscriptions in {len(channels)} channels")
 
 
-async def add_user(username, hash_code, conn):
+async def update_webhook(channel):
+    webhook = await channel.create_webhook(name='Twinx')
+    webhook_id = webhook.id
+    webhook_token = webhook.token
 
     try:
-        await conn.execute('INSERT INTO twitterUsers VALUES ($1, $2)', username, hash_code)
-        info_logger.debug(f"@{username} was added to 'Twitter Users'")
+        await pool.execute('UPDATE channels SET "webhookId" = $1, "webhookToken" = $2 WHERE "channelId" = $3', webhook_id, webhook_token, channel.id)
+        subscription_cache.set_webhook(channel.id, webhook_id, webhook_token)
+        metrics.webhook_recreations.inc()
+        info_logger.debug(f"Old webhook replaced by a new one for guild '{channel.guild.name}' in #{channel.name}")
     except Exception as e:
         db_logger.error(f"Error executing database query: {e}")
 
+    return (webhook_id, webhook_token)
+
+
+async def update_hashes(new_hashes, conn):
+    '''Writes back every changed hash and seen index of an update cycle in a single statement'''
+    if not new_hashes:
+        return
+    usernames = [username for (username, _, _) in new_hashes]
+    hashes = [new_hash for (_, new_hash, _) in new_hashes]
+    seen = [new_seen for (_, _, new_seen) in new_hashes]
+    await conn.execute('''UPDATE twitterUsers SET "hash" = new."hash", "seen" = new."seen"
+                          FROM unnest($1::text[], $2::text[], $3::bytea[]) AS new("username", "hash", "seen")
+                          WHERE twitterUsers."username" = new."username"''', usernames, hashes, seen)
+    info_logger.debug(f'Hash updated for {len(new_hashes)} users')
+
+
+async def queue_deliveries(deliveries, conn):
+    '''Adds (channel_id, msg, name, avatar_url, media urls) messages to the outbox, in order'''
+    if not deliveries:
+        return
+    (channel_ids, contents, names, avatar_urls, media_urls) = zip(*deliveries)
+    await conn.execute('''INSERT INTO outbox ("channelId", "content", "name", "avatarUrl", "media")
+                          SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::text[])''',
+                       channel_ids, contents, names, avatar_urls, media_urls)
+
+
+async def claim_outbox(limit, conn):
+    '''Claims up to limit due messages, skipping rows other workers hold, and hides them for OUTBOX_VISIBILITY seconds.
+    Rows of a worker that dies mid-delivery show up again once that time is over'''
+    rows = await conn.fetch('''UPDATE outbox SET "attempts" = "attempts" + 1,
+                                                "availableAt" = now() + make_interval(secs => $2)
+                               WHERE "id" IN (SELECT "id" FROM outbox WHERE "availableAt" <= now()
+                                              ORDER BY "id" LIMIT $1 FOR UPDATE SKIP LOCKED)
+                               RETURNING "id", "channelId", "content", "name", "avatarUrl", "media"''', limit, float(OUTBOX_VISIBILITY))
+    return sorted(rows, key=lambda row: row['id'])
+
+
+async def complete_outbox(ids, conn):
+
+    if ids:
+        await conn.execute('DELETE FROM outbox WHERE "id" = ANY($1::bigint[])', ids)
+
+
+async def retry_outbox(ids, conn):
+    '''Schedules failed messages again with exponential backoff and jitter, and drops the ones out of attempts.
+    Returns the number of dropped messages'''
+    if not ids:
+        return 0
+    async with conn.transaction():
+        dropped = await conn.fetch('DELETE FROM outbox WHERE "id" = ANY($1::bigint[]) AND "attempts" >= $2 RETURNING "id"',
+                                   ids, OUTBOX_MAX_ATTEMPTS)
+        await conn.execute('''UPDATE outbox SET "availableAt" = now() + make_interval(
+                                  secs => least($2 * power(2, "attempts" - 1), 3600) * (0.5 + random() / 2))
+                              WHERE "id" = ANY($1::bigint[])''', ids, float(OUTBOX_RETRY_BASE))
+    return len(dropped)
+
 
 async def add_guild(guild, conn):
 
     try:
-       await conn.execute('INSERT INTO guilds VALUES ($1)', guild.id)
-       info_logger.debug(f"The guild '{guild.name}' was successfully added to the database.")
+       status = await conn.execute('INSERT INTO guilds VALUES ($1) ON CONFLICT ("guildId") DO NOTHING', guild.id)
+       if status == 'INSERT 0 1':
+           info_logger.debug(f"The guild '{guild.name}' was successfully added to the database.")
     except Exception as e:
         db_logger.info(f"Error executing database query: {e}")
 
 
 async def add_channel(channel, conn):
 
-    if not await guild_in_db(channel.guild.id, conn):
-        await add_guild(channel.guild, conn)
+    await add_guild(channel.guild, conn)
 
     (webhook_id, webhook_token) = await create_webhook(channel)
 
     try:
         await conn.execute('INSERT INTO channels VALUES ($1, $2, $3, $4)', channel.id, webhook_id, webhook_token, channel.guild.id)
+        subscription_cache.set_webhook(channel.id, webhook_id, webhook_token)
         info_logger.debug(f"Channel #{channel.name} from guild '{channel.guild.name}' was successfully added to the database.")
     except Exception as e:
         db_logger.error(f"Error executing database query: {e}")
+        await delete_webhook(webhook_id, webhook_token)
 
 
-async def add_sub(username, channel, conn):
+async def add_subscriptions(users, channel, conn):
+    '''Adds the guild, the channel, the (username, hash, seen) users and their subscriptions in one transaction.
+    Returns the usernames the channel wasn't subscribed to yet'''
 
-    try:
-        await conn.execute('INSERT INTO subs VALUES ($1, $2)', username, channel.id)
-        info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now subbed to @{username}.")
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
+    webhook = subscription_cache.webhook(channel.id)
+    if not webhook:
+        check = await fetch_webhook_details(conn, channel.id)
+        webhook = tuple(check[0]) if check else None
+    created = None
+    if not webhook:
+        webhook = created = await create_webhook(channel)
+    (usernames, hashes, seen) = zip(*users)
 
-
-async def list_sub(channel, conn):
-
-    user_list = await conn.fetch('SELECT "username" FROM subs where "channelId" = ($1)', channel.id)
-    return user_list
-
-
-async def remove_sub(username, channel, conn):
-    
     try:
-        if username != '<All>':
-            await conn.execute('DELETE FROM subs WHERE "username" = ($1) AND "channelId" = ($2)', username, channel.id)
-            info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now unsubbed to @{username}.")
-        else:
-            await conn.execute('DELETE FROM subs WHERE "channelId" = ($1)', channel.id)
-            info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now unsubbed to all active subsciptions.")
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
-            
-
+        async with conn.transaction():
+            await conn.execute('INSERT INTO guilds VALUES ($1) ON CONFLICT ("guildId") DO NOTHING', channel.guild.id)
+            await conn.execute('INSERT INTO channels VALUES ($1, $2, $3, $4) ON CONFLICT ("channelId") DO NOTHING',
+                               channel.id, *webhook, channel.guild.id)
+            if created:                     # another command may have added the channel in the meantime
+                webhook = tuple((await fetch_webhook_details(conn, channel.id))[0])
+            await conn.execute('''INSERT INTO twitterUsers ("username", "hash", "seen")
+                                  SELECT * FROM unnest($1::text[], $2::text[], $3::bytea[])
+                                  ON CONFLICT ("username") DO UPDATE SET "hash" = EXCLUDED."hash", "seen" = EXCLUDED."seen"
+                                  WHERE NOT EXISTS (SELECT 1 FROM subs WHERE subs."username" = twitterUsers."username")''',
+                               usernames, hashes, seen)     # accounts nobody follows anymore start over from the current feed
+            added = await conn.fetch('''INSERT INTO subs SELECT "username", $2 FROM unnest($1::text[]) AS new("username")
+                                       ON CONFLICT ON CONSTRAINT sub_key DO NOTHING RETURNING "username"''', usernames, channel.id)
+    except Exception:
+        if created:
+            await delete_webhook(*created)
+        raise
+    if created and webhook != created:
+        await delete_webhook(*created)
+
+    subscription_cache.set_webhook(channel.id, *webhook)
+    added = [row['username'] for row in added]
+    for username in added:
+        subscription_cache.add(username, channel.id)
+    info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now subbed to {len(added)} users.")
+    return set(added)
+
+
+async def ensure_channel(channel, conn):
+    '''Returns the channel's webhook, adding the channel to the database when it isn't there yet'''
+
+    webhook = subscription_cache.webhook(channel.id)
+    if webhook:
+        return webhook
+
+    check = await fetch_webhook_details(conn, channel.id)
+    if check:
+        subscription_cache.set_webhook(channel.id, *check[0])
+    else:
+        await add_channel(channel, conn)
+    return subscription_cache.webhook(channel.id)
 
-async def remove_guild(guild_id, conn):
-
-    try:
-        await conn.execute('DELETE FROM guilds WHERE  "guildId" = ($1)', guild_id)
-        info_logger.debug(f"Guild with id '{guild_id}' was removed from the database due to having no active subscriptions")
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")       
 
+async def remove_sub(username, channel, conn):
+    '''Returns False when there was no subscription to remove, database errors are raised'''
+
+    if username != '<All>':
+        status = await conn.execute('DELETE FROM subs WHERE "username" = ($1) AND "channelId" = ($2)', username, channel.id)
+        if status == 'DELETE 0':
+            return False
+        subscription_cache.remove(username, channel.id)
+        info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now unsubbed to @{username}.")
+    else:
+        await conn.execute(REMOVE_CHANNEL_SUBS, channel.id)
+        subscription_cache.remove_all(channel.id)
+        info_logger.debug(f"#{channel.name} from guild '{channel.guild.name}' has now unsubbed to all active subsciptions.")
+    return True
 
-async def remove_twitterUser(username, conn):
 
-    try:
-        await conn.execute('DELETE FROM twitterUsers WHERE  "username" = ($1)', username)
-        info_logger.debug(f"Twitter user '@{username}' was removed from the database due to having no active subscriptions")
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
-        
 
 ##### Main bot functions #####
 
 # Sanity Check
 
 async def sanity_check(joinedGuilds):
+    '''Removes the guilds the bot has left and the twitter users nobody subscribes to anymore.
+    Guilds on other gateway shards are left alone, their own process checks them.
+    The deletes reach the subscription cache through the change listener'''
 
     logger.info('Starting sanity check...')
 
-    guilds = [joinedGuilds[i].id for i in range(len(joinedGuilds))]
-
-    conn = await create_connection()
-
-    guild_count = 0
-    twitterUsers_count = 0
-
-    active_guilds = await fetch_guild_lists(conn)
-
-    if len(active_guilds) > 0:
-        for guild_id in active_guilds:
-            if guild_id[0] not in guilds:
-                await remove_guild(guild_id[0], conn)
-                guild_count += 1
-
-    active_twitterUsers = await fetch_user_lists(conn)
-    users = [user[0] for user in active_twitterUsers]
-    subscribed_twitterUsers = await fetch_subscribed_users(conn)
-    subbed_users = [user[0] for user in subscribed_twitterUsers]
-
-    if len(subbed_users) > 0:
-        for i in range(len(users)):
-            if users[i] not in subbed_users:
-                await remove_twitterUser(users[i], conn)
-                twitterUsers_count += 1
-        
-    await close_connection(conn)
-    logger.info(f"{guild_count} servers removed")
-    logger.info(f"{twitterUsers_count} users removed")
+    guilds = [guild.id for guild in joinedGuilds]
+    shard_count = int(DISCORD_SHARD_COUNT) if DISCORD_SHARD_COUNT else None
+    shard_id = int(DISCORD_SHARD_ID) if DISCORD_SHARD_COUNT else None
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            guild_status = await conn.execute('''DELETE FROM guilds WHERE NOT EXISTS (
+                                                     SELECT 1 FROM unnest($1::bigint[]) AS joined("guildId")
+                                                     WHERE joined."guildId" = guilds."guildId")
+                                                 AND ($2::bigint IS NULL OR ("guildId" >> 22) % $2 = $3)''',
+                                              guilds, shard_count, shard_id)
+            user_status = await conn.execute('''DELETE FROM twitterUsers WHERE NOT EXISTS (
+                                                    SELECT 1 FROM subs WHERE subs."username" = twitterUsers."username")
+                                                AND EXISTS (SELECT 1 FROM subs)''')
+
+    logger.info(f"{guild_status.split()[-1]} servers removed")
+    logger.info(f"{user_status.split()[-1]} users removed")
     logger.info("Sanity check over")
     return
 
@@ -348,162 +699,263 @@ async def sanity_check(joinedGuilds):
 # Subscription functions
 
 async def create_subscription(users, channel):
+    '''Checks every handle concurrently (fetch_feed keeps FEED_CONCURRENCY requests in flight at most)
+    and adds all the subscriptions in one transaction'''
 
-    msg = ''
-    conn = await create_connection()
-
-    for user in users.split():
+    handles = list(dict.fromkeys(users.split()))
+    feeds = await asyncio.gather(*(get_feed(handle) for handle in handles))
 
-        feed = feedparser.parse(f'https://nitter.woodland.cafe/{user}/with_replies/rss')
-        if not feed.entries:
-            msg += f"No twitter users found for ``@{user}``. Please check and try again\n"
+    found = dict()                  # handle -> canonical username
+    new_users = dict()              # username -> (username, hash, seen)
+    for handle, feed in zip(handles, feeds):
+        if not feed or not feed.entries:
             continue
-        
         user = get_username(feed.feed.title)
-        hash_code = create_hash(feed.entries[0])
-
-        if not await sub_in_db(user, channel.id, conn):
-            if not await username_in_db(user, conn):
-                await add_user(user, hash_code, conn)
-            if not await channel_in_db(channel.id, conn):
-                await add_channel(channel, conn)
-        else:
+        found[handle] = user
+        new_users[user] = (user, create_hash(feed.entries[0]),
+                           advance_seen(None, [entry_id(entry) for entry in feed.entries]))
+
+    added = set()
+    if new_users:
+        try:
+            async with pool.acquire() as conn:
+                added = await add_subscriptions(list(new_users.values()), channel, conn)
+        except Exception as e:
+            db_logger.error(f"Error executing database query: {e}")
+            return "Something went wrong while saving the subscriptions. Please try again\n"
+
+    msg = ''
+    for handle in handles:
+        if handle not in found:
+            msg += f"No twitter users found for ``@{handle}``. Please check and try again\n"
+            continue
+        user = found[handle]
+        if user not in added:
             msg += f"There is already an ongoing subscription for ``@{user}`` in <#{channel.id}>\n"
             continue
-
-        await add_sub(user, channel, conn)
         msg += f"<#{channel.id}> is now subscribed to ``@{user}``.\n"
+        added.discard(user)                 # two handles resolving to one account are only reported once
 
-    await close_connection(conn)
     return msg
 
 
 async def remove_subscription(username, channel):
 
-    conn = await create_connection()
+    try:
+        async with pool.acquire() as conn:
+            removed = await remove_sub(username, channel, conn)
+    except Exception as e:
+        db_logger.error(f"Error executing database query: {e}")
+        return "Something went wrong while removing the subscription. Please try again"
 
     if username == '<All>':
-        await remove_sub(username, channel, conn)
-        await close_connection(conn)
         return f"Successfully removed all active subscriptions in <#{channel.id}>"
-    elif not await sub_in_db(username, channel.id, conn):
-        await close_connection(conn)
+    elif not removed:
         return f"``@{username}`` was not in the list of subscriptions for <#{channel.id}>"
     else:
-        await remove_sub(username, channel, conn)
-        await close_connection(conn)
         return f"Successfully unsubscribed to ``@{username}``"
 
 
 async def list_subscriptions(channel):
 
-    conn = await create_connection()
-
-    if not await channel_in_sub(channel.id, conn):
-        await close_connection(conn)
+    user_list = subscription_cache.users(channel.id)
+    if not user_list:
         return f"<#{channel.id}> has no active subscriptions."
-    else:
-        user_list = await list_sub(channel, conn)
-        subs = ''
-        count = len(user_list) + 1
 
-        for i in range(count - 1):
-            subs += f'{i+1}) ``@{user_list[i][0]}`` (https://twitter.com/{user_list[i][0]}/)\n'
+    subs = ''
+    count = len(user_list) + 1
+
+    for i in range(count - 1):
+        subs += f'{i+1}) ``@{user_list[i]}`` (https://twitter.com/{user_list[i]}/)\n'
 
-        list_embed = discord.Embed(
-                        title=f'**{count-1} Subscriptions**',
-                        description=subs,
-                        color=0x000000
-                    )
-        
-        await close_connection(conn)
-        return list_embed
+    list_embed = discord.Embed(
+                    title=f'**{count-1} Subscriptions**',
+                    description=subs,
+                    color=0x000000
+                )
+
+    return list_embed
 
 
 # Update Function
     
-async def get_updates():
+async def entry_media(entry):
+    '''URLs of the entry's images and videos that could be prepared for upload, space separated, or None.
+    The URLs go to the outbox rather than the cached files, as the process that delivers the message
+    may have its own media cache. Preparing them here means that is rarely more than a cache hit'''
+    urls = []
+    for url in media.media_urls(entry):
+        try:
+            name = await media_store.store(url, http_session)
+        except Exception as e:
+            logger.warning(f"Error preparing the media {url}: {e!r}")
+            continue
+        if name:
+            urls.append(url)
+    return ' '.join(urls) or None
 
-    tweets = dict()
-    subscription_webhooks = dict()
 
-    logger.info("--- Retrieving new tweets ---")
+update_lock = asyncio.Lock()
 
-    conn = await create_connection()
+async def get_updates(usernames, on_commit=None):
+    '''Polls the feeds of the given users and queues their new tweets in the outbox.
+    Runs as a pipeline connected by bounded queues, so tweets of a feed go out while other feeds are still being fetched:
+    the fetchers download and parse the feeds, the diff stage renders the new tweets of each parsed feed
+    (and prepares their media once for all channels when MEDIA_UPLOADS is on), and the commit stage writes whatever is ready to the outbox in one transaction and calls on_commit().
+    Returns ({username: number of new tweets}, number of queued messages)'''
 
-    user_hash_list = await fetch_user_hash_lists(conn)
+    if update_lock.locked():
+        logger.warning('The previous update cycle is still running, skipping this one')
+        return (dict(), 0)
 
-    for (user, stored_hash) in user_hash_list:
+    async with update_lock:
 
-        feed = feedparser.parse(f'https://nitter.woodland.cafe/{user}/with_replies/rss')
-        if feed.entries:
+        logger.info(f"--- Retrieving new tweets for {len(usernames)} users ---")
 
-            tweets[user] = list()
+        start = time.perf_counter()
+        user_hash_list = await fetch_user_hash_lists(pool, usernames)
+        db_seconds = time.perf_counter() - start        # every query of the cycle, recorded once at the end
+        metrics.cycle_feeds.observe(len(user_hash_list))
 
-            name = feed.feed.title
-            avatar_url = feed.feed.image['href']
-
-            add = False
-            no_of_tweets = len(feed.entries)
-            while no_of_tweets > 0:
-                if not add:
-                    compare_hash = create_hash(feed.entries[no_of_tweets-1])
-                    if compare_hash == stored_hash:
-                        add = True
-                else:
-                    msg = generate_message(name, feed.entries[no_of_tweets-1])
-                    tweets[user].append((msg, name, avatar_url))
-                no_of_tweets -= 1
-            if not add:                                                 # for sending just the latest tweet if no matching hash found
-                msg = generate_message(name, feed.entries[0])
-                tweets[user].append((msg, name, avatar_url))
-
-            new_hash = create_hash(feed.entries[0])
-            if stored_hash != new_hash:
-                await update_hash(user, new_hash, conn)
-
-        subscription_webhooks[user] = await fetch_subbed_webhook_details(conn, user)
-    
-    await close_connection(conn)
+        fetched = asyncio.Queue(UPDATE_QUEUE_SIZE)      # (user, stored hash, seen, known ids, feed, modified), None when done
+        rendered = asyncio.Queue(UPDATE_QUEUE_SIZE)     # ((user, hash, seen), outbox rows, new tweets), None when done
+        pending = iter(user_hash_list)                  # shared by the fetchers, every row is taken once
+        new_counts = dict()
+        queued = 0
 
-    logger.info("--- Finished retrieving new tweets ---")
+        async def fetch_stage():
+            for (user, stored_hash, seen) in pending:
+                known = load_seen(seen) if seen else None
+                is_known = (lambda entry: entry_id(entry) in known) if known else None
+                try:
+                    (feed, modified) = await fetch_feed(user, http_session, poll=True, is_known=is_known)
+                except Exception as e:
+                    logger.error(f"Error fetching the feed of @{user}: {e!r}")
+                    continue
+                await fetched.put((user, stored_hash, seen, known, feed, modified))
 
-    return (tweets, subscription_webhooks)
+        async def render(user, stored_hash, seen, known, feed):
+            '''The new tweets of one feed as ((user, hash, seen), outbox rows, new tweets), None when there are none'''
+
+            name = feed.feed.title
+            avatar_url = feed.feed.get('image', {}).get('href')
+
+            if seen:
+                new_entries = [entry for entry in feed.entries if entry_id(entry) not in known]
+            else:
+                new_entries = entries_since_hash(feed.entries, stored_hash)
+            if not new_entries and seen:
+                return None
+
+            new_entries = new_entries[::-1]             # oldest first
+            messages = [generate_message(name, entry) for entry in new_entries]
+            if media_store:
+                attachments = await asyncio.gather(*(entry_media(entry) for entry in new_entries))
+            else:
+                attachments = [None] * len(new_entries)
+            channels = subscription_cache.channels(user)
+            deliveries = [(channel_id, msg, name, avatar_url, media_urls)
+                          for (msg, media_urls) in zip(messages, attachments) for channel_id in channels]
+            new_seen = advance_seen(seen, [entry_id(entry) for entry in feed.entries])
+            return ((user, create_hash(feed.entries[0]), new_seen), deliveries, len(new_entries))
+
+        async def diff_stage():
+            while (item := await fetched.get()) is not None:
+                (user, stored_hash, seen, known, feed, modified) = item
+                if not (feed and modified and feed.entries):
+                    continue
+                try:
+                    result = await render(user, stored_hash, seen, known, feed)
+                except Exception as e:                  # one odd feed must not stop the cycle for everybody else
+                    logger.error(f"Error reading the new tweets of @{user}: {e!r}")
+                    forget_feed(user)
+                    continue
+                if result:
+                    await rendered.put(result)
+            await fetched.put(None)                     # lets the other diff workers stop too
+
+        async def diff_all():
+            await asyncio.gather(*(diff_stage() for _ in range(MEDIA_CONCURRENCY if media_store else 1)))
+            await rendered.put(None)
+
+        async def commit_stage():
+            nonlocal queued, db_seconds
+            done = False
+            while not done:
+                batch = [await rendered.get()]
+                while len(batch) < UPDATE_COMMIT_BATCH and not rendered.empty():
+                    batch.append(rendered.get_nowait())
+                if batch[-1] is None:
+                    done = True
+                    batch.pop()
+                if not batch:
+                    continue
+
+                new_hashes = [new_hash for (new_hash, _, _) in batch]
+                deliveries = [delivery for (_, user_deliveries, _) in batch for delivery in user_deliveries]
+                start = time.perf_counter()
+                try:
+                    async with pool.acquire() as conn:
+                        async with conn.transaction():      # the seen indexes only move forward together with the queued messages
+                            await update_hashes(new_hashes, conn)
+                            await queue_deliveries(deliveries, conn)
+                except Exception as e:
+                    db_logger.error(f"Error executing database query: {e}")
+                    for (user, _, _) in new_hashes:         # polled again from scratch, the seen indexes didn't move
+                        forget_feed(user)
+                    continue
+                finally:
+                    db_seconds += time.perf_counter() - start
+                for ((user, _, _), _, count) in batch:
+                    new_counts[user] = count
+                    metrics.new_tweets.inc(count)
+                queued += len(deliveries)
+                if deliveries and on_commit:
+                    on_commit()
+
+        async def fetch_all():
+            with metrics.cycle_stage_seconds.time(stage='fetch'):     # downloads and parsing, until the last feed is in
+                await asyncio.gather(*(fetch_stage() for _ in range(min(FEED_CONCURRENCY, len(user_hash_list)))))
+            await fetched.put(None)
+
+        stages = [asyncio.create_task(stage()) for stage in (fetch_all, diff_all, commit_stage)]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for task in stages:                         # a failing stage must not leave the others blocked on its queue
+                task.cancel()
+        metrics.cycle_stage_seconds.observe(db_seconds, stage='db')
+
+        logger.info("--- Finished retrieving new tweets ---")
+
+        return (new_counts, queued)
 
 
 # Misc Functions
 
 async def get_latest_tweet(username, channel):
     
-    feed = feedparser.parse(f'https://nitter.woodland.cafe/{username}/with_replies/rss')
+    feed = await get_feed(username)
 
-    if not feed.entries:
+    if not feed or not feed.entries:
         return False
     
     name = feed.feed.title
     username = get_username(name)
-    avatar_url = feed.feed.image['href']
+    avatar_url = feed.feed.get('image', {}).get('href')
     message = generate_message(name, feed.entries[0])
     channel_id = channel.id
 
-    conn = await create_connection()
-
-    try:
-        check = await fetch_webhook_details(conn, channel_id)
-
-        if not check:
-            await add_channel(channel, conn)
-            check = await fetch_webhook_details(conn, channel_id)
-            (webhook_id, webhook_token) = check[0]
-        else:
-            (webhook_id, webhook_token) = check[0]
-    
-    except Exception as e:
-        db_logger.error(f"Error executing database query: {e}")
-
-    finally:
-        await close_connection(conn)
-
-
+    webhook = subscription_cache.webhook(channel_id)
+    if not webhook:
+        async with pool.acquire() as conn:
+            try:
+                webhook = await ensure_channel(channel, conn)
+            except Exception as e:
+                db_logger.error(f"Error executing database query: {e}")
+        if not webhook:
+            return False
+
+    (webhook_id, webhook_token) = webhook
     return (message, name, avatar_url, webhook_id, webhook_token)
 